@@ -1,21 +1,67 @@
-from services import db, app, cipher_suite
+from services import db, app, cipher_suite, connection_string
 from models import User, City, Building, Outpost
 import dotenv
+import hashlib
+import json
 import os
 from flask import request, make_response, jsonify
 from flask_cors import CORS
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import text
+from sqlalchemy import func, tuple_
 import numpy as np
-from proc_map import Map
-
-m = Map()
+from proc_map import Map, world_params
+from proc_map.map import LAYERS
+from proc_map.encoding import ENCODINGS, encode_region
+from proc_map.resources import resources
+from serializers import building_dicts, outpost_dicts, city_dicts
+from occupancy import OccupancyIndex, OutpostIndex, PlacementListener, Reconciler, register, lock_tiles, occupied_tiles
+from positions import PositionBuffer
+
+m = Map(**world_params(), lazy=True)
+# Tiles taken by outposts and buildings, for placement collision checks
+occupancy = register(OccupancyIndex())
+# Outposts bucketed per city, for finding the outpost a building belongs to
+outpost_index = register(OutpostIndex())
 
 dotenv.load_dotenv()
 
 server_port = os.getenv('SRV_PORT')
 
+# Player positions are buffered and written to the database in batches
+positions = PositionBuffer(app, flush_interval=float(os.getenv('POSITION_FLUSH_INTERVAL') or "5"),
+                           max_staleness=float(os.getenv('POSITION_MAX_STALENESS') or "30"))
+positions.start()
+
+# Other processes' commits reach the indexes through Postgres NOTIFY; the
+# rare one missed while the listener reconnects is repaired on a schedule
+reconciler = Reconciler(app, interval=float(os.getenv('INDEX_RECONCILE_INTERVAL') or "600"))
+reconciler.start()
+listener = PlacementListener(connection_string, on_connect=reconciler.reconcile)
+listener.start()
+
+# Accept header media types for the non-default map_data encodings
+MAP_ENCODING_TYPES = {
+    'application/vnd.voltforge.planes+json': 'planes',
+    'application/vnd.voltforge.rle+json': 'rle',
+}
+# Largest number of placements/removals accepted by /buildings/batch
+MAX_BATCH_ITEMS = 500
+# Largest /map radius at lod 0, in tiles. Each level up doubles it, so a
+# response is about the same size at every level
+MAX_MAP_RADIUS = int(os.getenv('MAP_MAX_RADIUS') or "256")
+# Missing chunks a lazy map generates for one request before it answers
+# 503 and leaves the rest to the client's retries
+MAX_GENERATED_CHUNKS = int(os.getenv('MAP_MAX_GENERATED_CHUNKS') or "2")
+
+
+def warm_indexes():
+    # Called once at startup, so no request waits on the first load
+    with app.app_context():
+        occupancy.warm()
+        outpost_index.warm()
+
 
 def encode_key(key):
     return cipher_suite.encrypt(key.encode()).decode()
@@ -54,40 +100,118 @@ def check_existing_user(username, email):
 
 
 def delete_city_and_related(city, user):
-    # Delete all outposts and associated buildings of the city
-    for outpost in city.outposts:
-        Building.query.filter_by(outpost_id=outpost.id).delete()
-        db.session.delete(outpost)
-
-    # Delete the city
+    # Delete the city, its outposts and buildings go by ON DELETE CASCADE
     db.session.delete(city)
 
     # Delete the user
+    positions.forget(user.id)
     db.session.delete(user)
 
     db.session.commit()
 
 
-def get_coordinates():
-    x = int(request.args.get('x') or current_user.position[0])
-    y = int(request.args.get('y') or current_user.position[1])
-    r = int(request.args.get('r') or "50")
+# The map helpers take an explicit request so the ASGI /map path can share
+# them; Flask views leave it out and get the current request.
+
+def get_coordinates(req=None, user_id=None, position=None):
+    if req is None:
+        req, user_id, position = request, current_user.id, current_user.position
+    position = positions.get(user_id) or position
+    x = int(req.args.get('x') or position[0])
+    y = int(req.args.get('y') or position[1])
+    r = int(req.args.get('r') or "50")
     return x, y, r
 
 
+def get_map_encoding(req=None):
+    req = request if req is None else req
+    # ?encoding= wins over the Accept header, JSON lists are the default
+    if encoding := req.args.get('encoding'):
+        return encoding
+    best = req.accept_mimetypes.best_match(
+        ['application/json', *MAP_ENCODING_TYPES])
+    return MAP_ENCODING_TYPES.get(best, 'json')
+
+
+def get_map_detail(req=None):
+    req = request if req is None else req
+    # ?layers=0,4 picks layers by index, ?lod=n reads pyramid level n
+    lod = int(req.args.get('lod') or "0")
+    if not 0 <= lod <= m.max_lod:
+        raise ValueError(f'lod must be between 0 and {m.max_lod}')
+    layers = list(range(LAYERS))
+    if req.args.get('layers'):
+        layers = [int(layer) for layer in req.args['layers'].split(',')]
+        if not all(0 <= layer < LAYERS for layer in layers):
+            raise ValueError(f'layers must be between 0 and {LAYERS - 1}')
+    return layers, lod
+
+
+def get_map_region(x, y, r, layers, lod):
+    region = m.get_region(x, y, r, lod=lod)
+    if layers != list(range(LAYERS)):
+        region = region[..., layers]
+    return region
+
+
+def check_map_window(x, y, r, lod=0):
+    """
+    None if the window of radius r around (x, y) can be served at lod,
+    else (message, status). Generates up to MAX_GENERATED_CHUNKS of the
+    chunks the window is missing, so each retry of a 503 gets further.
+    """
+    max_r = MAX_MAP_RADIUS * 2 ** lod
+    if not 0 <= r <= max_r:
+        return f'r must be between 0 and {max_r} at lod {lod}!', 400
+    missing = m.missing_chunks(*m.region_window(x, y, r, lod), lod=lod)
+    if len(missing) > MAX_GENERATED_CHUNKS:
+        for chunk_row, chunk_col in missing[:MAX_GENERATED_CHUNKS]:
+            m.load_chunk(chunk_row, chunk_col)
+        return f'{len(missing) - MAX_GENERATED_CHUNKS} map chunks are still being generated, try again!', 503
+    return None
+
+
+def within_range(model, x, y, r):
+    return model.x.between(x - r, x + r), model.y.between(y - r, y + r)
+
+
+def map_payload(x, y, lod, layers, encoding, region, buildings, outposts):
+    return {"center": [x, y],
+            "lod": lod,
+            # The ?v= that makes tiles at this lod cacheable for good
+            "world_version": world_version(lod),
+            "layers": layers,
+            "map_data": encode_region(region, encoding),
+            "buildings": buildings,
+            "outposts": outposts}
+
+
 def check_if_building_exists(x, y):
-    return bool(
-        Outpost.query.filter(
-            text("(coord->>0)::int = :x and (coord->>1)::int = :y")
-        )
-        .params(x=x, y=y)
-        .first()
-        or Building.query.filter(
-            text("(coord->>0)::int = :x and (coord->>1)::int = :y")
-        )
-        .params(x=x, y=y)
-        .first()
-    )
+    # The index turns most taken tiles away. A free one is confirmed by the
+    # database under a tile lock, held until the placement commits
+    if occupancy.is_occupied(x, y):
+        return True
+    lock_tiles(db.session, [(x, y)])
+    return bool(occupied_tiles(db.session, [(x, y)]))
+
+
+def nearest_outpost(city_id, x, y, dx=20, dy=10, exclude=()):
+    """
+    The outpost of city_id nearest (x, y) within dx, dy by Manhattan
+    distance, ties to the oldest, skipping ids in exclude. The index
+    answers first; one it hasn't heard of yet is found in the database.
+    """
+    candidates = [(abs(ox - x) + abs(oy - y), outpost_id)
+                  for outpost_id, ox, oy in outpost_index.within(city_id, x, y, dx, dy)
+                  if outpost_id not in exclude]
+    outpost = candidates and db.session.get(Outpost, min(candidates)[1])
+    if outpost:
+        return outpost
+    query = Outpost.query.filter(Outpost.city_id == city_id,
+                                 Outpost.x.between(x - dx, x + dx), Outpost.y.between(y - dy, y + dy))
+    if exclude:
+        query = query.filter(Outpost.id.notin_(exclude))
+    return query.order_by(func.abs(Outpost.x - x) + func.abs(Outpost.y - y), Outpost.id).first()
 
 
 def create_building(x, y, id, current_user):
@@ -107,8 +231,7 @@ def create_building(x, y, id, current_user):
     else:
         # This is a building
         # First, check if the building is within 20 units of an outpost
-        outpost = Outpost.query.filter(text(
-            "abs((coord->>0)::int - :x) <= 20 and abs((coord->>1)::int - :y) <= 10 and city_id = :city_id")).params(x=x, y=y, city_id=current_user.city_id).order_by(text("abs((coord->>0)::int - :x) + abs((coord->>1)::int - :y)")).first()
+        outpost = nearest_outpost(current_user.city_id, x, y)
 
         if not outpost:
             return handle_response('No outpost found within 10 units of this location!', 400)
@@ -141,6 +264,13 @@ def login():
         )
 
 
+@app.route('/api_key', methods=['GET'])
+@login_required
+def get_api_key():
+    # Sent as the X-API-Key header to authenticate without a session
+    return make_response(jsonify({'api_key': current_user.get_key()}), 200)
+
+
 @app.route('/logout', methods=['POST'])
 @login_required
 def logout():
@@ -215,34 +345,227 @@ def create_user():
 def handle_map():
     if request.method == 'GET':
         x, y, r = get_coordinates()
-        region = m.get_region(x, y, r)
+        encoding = get_map_encoding()
+        if encoding not in ENCODINGS:
+            return handle_response(f'Unknown map encoding {encoding}!', 400)
+        try:
+            layers, lod = get_map_detail()
+        except ValueError as e:
+            return handle_response(f'Invalid map detail: {e}!', 400)
+        if not m.level_available(lod):
+            return handle_response(f'Map level {lod} has not been built yet!', 503)
+        if error := check_map_window(x, y, r, lod):
+            return handle_response(*error)
+        region = get_map_region(x, y, r, layers, lod)
 
         # Query for buildings and outposts within the specified range
-        buildings = Building.query.filter(text(
-            "(coord->>0)::int between :xmin and :xmax and (coord->>1)::int between :ymin and :ymax")).params(xmin=x-r, xmax=x+r, ymin=y-r, ymax=y+r).all()
-        outposts = Outpost.query.filter(text(
-            "(coord->>0)::int between :xmin and :xmax and (coord->>1)::int between :ymin and :ymax")).params(xmin=x-r, xmax=x+r, ymin=y-r, ymax=y+r).all()
-        for outpost in outposts:
-            outpost.serialize_rules = ('-buildings', '-city',)
-        return make_response(jsonify({"center": [x, y],
-                                      "map_data": region,
-                                      "buildings": [building.to_dict() for building in buildings],
-                                      "outposts": [outpost.to_dict() for outpost in outposts]}), 200)
+        buildings = building_dicts(*within_range(Building, x, y, r))
+        outposts = outpost_dicts(*within_range(Outpost, x, y, r))
+        response = make_response(jsonify(map_payload(
+            x, y, lod, layers, encoding, region, buildings, outposts)), 200)
+        response.vary.add('Accept')
+        return response
     if request.method == 'POST':
         data = get_request_data()
         print(data)
         pos = data.get('position')
-        current_user.position = pos
-        db.session.commit()
+        positions.record(current_user.id, pos)
         return handle_response('Position updated successfully!', 200)
 
 
+def world_version(lod=0):
+    """
+    Version of the world data at lod, from the build ID of the store the
+    server has open. A chunk never changes once written, and rebuilding a
+    level (with any pipeline) creates a new store with a new build ID, so
+    tile ETags only need this and the tile address.
+    """
+    return hashlib.sha256(json.dumps([m.params(), m.get_store(lod).build_id],
+                                     sort_keys=True).encode()).hexdigest()
+
+
+# Tile URLs carrying the current ?v= never change, any other URL has to be
+# revalidated against its ETag, so a rebuild reaches every client
+TILE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+UNVERSIONED_CACHE_CONTROL = 'public, no-cache'
+
+
+def tile_cache_control(version):
+    return TILE_CACHE_CONTROL if request.args.get('v') == version else UNVERSIONED_CACHE_CONTROL
+STRUCTURE_CACHE_CONTROL = 'private, max-age=5'
+
+
+def tile_bounds(level, tx, ty):
+    # Level 0 (min_x, min_y, max_x, max_y) covered by tile (level, tx, ty)
+    size = m.chunk_size * 2 ** level
+    return tx * size, ty * size, min(m.width, (tx + 1) * size), min(m.height, (ty + 1) * size)
+
+
+def valid_tile(level, tx, ty):
+    if not 0 <= level <= m.max_lod:
+        return False
+    height, width = m.level_shape(level)
+    return tx * m.chunk_size < width and ty * m.chunk_size < height
+
+
+@app.route('/map/tiles/<int:level>/<int:tx>/<int:ty>', methods=['GET'])
+def handle_tile(level, tx, ty):
+    """
+    One chunk-aligned block of pyramid level `level`, public and cacheable
+    for good under ?v=<world_version from /map at that lod>. Structures on
+    it come from the structures endpoint below.
+    """
+    if not valid_tile(level, tx, ty):
+        return handle_response('Tile does not exist!', 404)
+    if not m.level_available(level):
+        return handle_response(f'Map level {level} has not been built yet!', 503)
+    encoding = get_map_encoding()
+    if encoding not in ENCODINGS:
+        return handle_response(f'Unknown map encoding {encoding}!', 400)
+    try:
+        layers, _ = get_map_detail()
+    except ValueError as e:
+        return handle_response(f'Invalid map detail: {e}!', 400)
+
+    version = world_version(level)
+    etag = hashlib.sha256(
+        f'{version}/{level}/{tx}/{ty}/{encoding}/{layers}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        chunk = m.load_chunk(ty, tx, lod=level)
+        if layers != list(range(LAYERS)):
+            chunk = chunk[..., layers]
+        response = make_response(jsonify({"level": level,
+                                          "tile": [tx, ty],
+                                          "bounds": list(tile_bounds(level, tx, ty)),
+                                          "layers": layers,
+                                          "map_data": encode_region(chunk, encoding)}), 200)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = tile_cache_control(version)
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/map/tiles/<int:level>/<int:tx>/<int:ty>/structures', methods=['GET'])
+@login_required
+def handle_tile_structures(level, tx, ty):
+    if not valid_tile(level, tx, ty):
+        return handle_response('Tile does not exist!', 404)
+    min_x, min_y, max_x, max_y = tile_bounds(level, tx, ty)
+    area = (min_x <= Building.x, Building.x < max_x, min_y <= Building.y, Building.y < max_y)
+    buildings = building_dicts(*area)
+    area = (min_x <= Outpost.x, Outpost.x < max_x, min_y <= Outpost.y, Outpost.y < max_y)
+    outposts = outpost_dicts(*area)
+    response = make_response(jsonify({"bounds": [min_x, min_y, max_x, max_y],
+                                      "buildings": buildings,
+                                      "outposts": outposts}), 200)
+    response.headers['Cache-Control'] = STRUCTURE_CACHE_CONTROL
+    return response
+
+
+# Resource names by ID, and the most deposits a single query returns
+RESOURCE_NAMES = {attributes['id']: name for name, attributes in resources.items()}
+MAX_DEPOSITS = 100
+
+
+def get_deposit_query():
+    # ?resource=Uranium (name or ID), ?stage=0..3, position defaults as for /map
+    resource = request.args.get('resource', '')
+    if resource.isdigit() and int(resource) in RESOURCE_NAMES:
+        resource_id = int(resource)
+    else:
+        matches = [attributes['id'] for name, attributes in resources.items()
+                   if name.lower() == resource.lower()]
+        if not matches:
+            raise ValueError(f'unknown resource {resource}')
+        resource_id = matches[0]
+    stage = int(request.args.get('stage') or "0")
+    if not 0 <= stage < 4:
+        raise ValueError('stage must be between 0 and 3')
+    x, y, _ = get_coordinates()
+    return resource_id, stage, x, y
+
+
+def get_deposits():
+    # None until the world's sites have been saved by a build
+    try:
+        return m.deposits
+    except ValueError:
+        return None
+
+
+def deposit_dicts(deposits):
+    return [{"x": x, "y": y, "distance": distance} for x, y, distance in deposits]
+
+
+@app.route('/deposits/nearest', methods=['GET'])
+@login_required
+def handle_nearest_deposits():
+    try:
+        resource_id, stage, x, y = get_deposit_query()
+        k = min(int(request.args.get('k') or "1"), MAX_DEPOSITS)
+    except ValueError as e:
+        return handle_response(f'Invalid deposit query: {e}!', 400)
+    index = get_deposits()
+    if index is None:
+        return handle_response('Deposit sites have not been built yet!', 503)
+    deposits = index.nearest(stage, resource_id, x, y, k=max(1, k))
+    return make_response(jsonify({"resource": RESOURCE_NAMES[resource_id],
+                                  "stage": stage,
+                                  "center": [x, y],
+                                  "deposits": deposit_dicts(deposits)}), 200)
+
+
+@app.route('/deposits/within', methods=['GET'])
+@login_required
+def handle_deposits_within():
+    try:
+        resource_id, stage, x, y = get_deposit_query()
+        radius = float(request.args.get('radius') or "50")
+        # No deposit is further away than the world's diagonal
+        radius = min(radius, float(np.hypot(m.width, m.height)))
+    except ValueError as e:
+        return handle_response(f'Invalid deposit query: {e}!', 400)
+    index = get_deposits()
+    if index is None:
+        return handle_response('Deposit sites have not been built yet!', 503)
+    deposits = index.within(stage, resource_id, x, y, radius, limit=MAX_DEPOSITS)
+    return make_response(jsonify({"resource": RESOURCE_NAMES[resource_id],
+                                  "stage": stage,
+                                  "center": [x, y],
+                                  "radius": radius,
+                                  "deposits": deposit_dicts(deposits)}), 200)
+
+
+@app.route('/deposits/histogram/<int:tx>/<int:ty>', methods=['GET'])
+def handle_deposit_histogram(tx, ty):
+    # Tiles of each resource per stage in one level 0 chunk, cached like
+    # tiles under the lod 0 ?v=
+    if not valid_tile(0, tx, ty):
+        return handle_response('Tile does not exist!', 404)
+    version = world_version(0)
+    etag = hashlib.sha256(f'{version}/histogram/{tx}/{ty}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        histogram = m.chunk_histogram(ty, tx)
+        response = make_response(jsonify({"tile": [tx, ty],
+                                          "bounds": list(tile_bounds(0, tx, ty)),
+                                          "stages": [{RESOURCE_NAMES[resource_id]: int(count)
+                                                      for resource_id, count in enumerate(stage) if count}
+                                                     for stage in histogram]}), 200)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = tile_cache_control(version)
+    return response
+
+
 @app.route('/city', methods=['GET', 'POST'])
 @login_required
 def handle_cities():
     if request.method == 'GET':
-        if cities := City.query.filter_by(id=current_user.city_id).all():
-            return make_response(jsonify({'cities': [city.to_dict() for city in cities]}), 200)
+        if cities := city_dicts(City.id == current_user.city_id):
+            return make_response(jsonify({'cities': cities}), 200)
         else:
             return handle_response('No cities found for current user!', 400)
     elif request.method == 'POST':
@@ -264,11 +587,9 @@ def handle_cities():
 @login_required
 def handle_outpost():
     if request.method == 'GET':
-        outposts = City.query.filter_by(id=current_user.city_id).one().outposts
-        for outpost in outposts:
-            outpost.serialize_rules = ('-city',)
-            # outpost.to_dict()  # serialize
-        return make_response(jsonify({'outposts': [outpost.to_dict() for outpost in outposts]}), 200)
+        outposts = outpost_dicts(
+            Outpost.city_id == current_user.city_id, buildings=True)
+        return make_response(jsonify({'outposts': outposts}), 200)
 
     elif request.method == 'POST':
         data = get_request_data()
@@ -284,8 +605,7 @@ def handle_outpost():
         data = get_request_data()
         x = data.get('x')
         y = data.get('y')
-        outpost = Outpost.query.filter(
-            text("(coord->>0)::int = :x and (coord->>1)::int = :y")).params(x=x, y=y).first()
+        outpost = Outpost.query.filter_by(x=x, y=y).first()
         if y and x and outpost and outpost.city_id == current_user.city_id:
             db.session.delete(outpost)
             db.session.commit()
@@ -311,8 +631,7 @@ def handle_buildings():
         data = get_request_data()
         x = data.get('x')
         y = data.get('y')
-        building = Building.query.filter(
-            text("(coord->>0)::int = :x and (coord->>1)::int = :y")).params(x=x, y=y).first()
+        building = Building.query.options(joinedload(Building.outpost)).filter_by(x=x, y=y).first()
         if y and x and building and building.outpost.city_id == current_user.city_id:
             db.session.delete(building)
             db.session.commit()
@@ -320,10 +639,121 @@ def handle_buildings():
         return handle_response('Target building does not exist', 400)
 
 
+def apply_batch(items, user):
+    """
+    Validate and stage a list of {"op": "place", "x", "y", "id"} and
+    {"op": "remove", "x", "y"} items in order, against the database plus
+    the effect of earlier items. Buildings are never attached to an outpost the
+    batch removes, and removing an outpost frees its buildings' tiles.
+    Returns one result per item; the caller commits everything that
+    succeeded in one transaction.
+    """
+    coords = [(item.get('x'), item.get('y')) for item in items]
+    # One query per table for everything the batch might remove
+    removable = {}
+    removal_coords = [coord for item, coord in zip(items, coords)
+                      if item.get('op') == 'remove']
+    if removal_coords:
+        buildings = Building.query.options(joinedload(Building.outpost)).filter(
+            tuple_(Building.x, Building.y).in_(removal_coords)).all()
+        outposts = Outpost.query.filter(
+            tuple_(Outpost.x, Outpost.y).in_(removal_coords)).all()
+        for target in buildings + outposts:
+            removable.setdefault((target.x, target.y), target)
+    # Outposts the batch removes, at any point, and the tiles of their
+    # buildings, which the database deletes with them. No placement in the
+    # batch may depend on one of these outposts
+    doomed = {target.id for target in removable.values()
+              if isinstance(target, Outpost) and target.city_id == user.city_id}
+    cascaded = {}
+    if doomed:
+        for outpost_id, bx, by in db.session.query(Building.outpost_id, Building.x, Building.y).filter(
+                Building.outpost_id.in_(doomed)).all():
+            cascaded.setdefault(outpost_id, []).append((bx, by))
+
+    # The index only pre-checks; tiles the batch places on are locked and
+    # checked in the database, which has the final say
+    placements = [coord for item, coord in zip(items, coords) if item.get('op') == 'place'
+                  and isinstance(coord[0], int) and isinstance(coord[1], int)]
+    lock_tiles(db.session, placements)
+    taken = occupied_tiles(db.session, placements)
+
+    outposts_owned = len(user.city.outposts)
+    placed, freed, new_outposts = set(), set(), []
+    results = []
+    for item, (x, y) in zip(items, coords):
+        op = item.get('op')
+        if not isinstance(x, int) or not isinstance(y, int):
+            results.append({'ok': False, 'message': 'x and y must be integers!'})
+        elif op == 'remove':
+            target = removable.pop((x, y), None)
+            city_id = target and (target.city_id if isinstance(
+                target, Outpost) else target.outpost.city_id)
+            if target is None or city_id != user.city_id:
+                results.append({'ok': False, 'message': 'Target does not exist!'})
+                continue
+            db.session.delete(target)
+            freed.add((x, y))
+            if isinstance(target, Outpost):
+                freed.update(cascaded.get(target.id, []))
+                outposts_owned -= 1
+            results.append({'ok': True})
+        elif op == 'place':
+            if (x, y) in placed or ((x, y) in taken and (x, y) not in freed):
+                results.append({'ok': False, 'message': 'There is already a building here!'})
+                continue
+            if item.get('id') == 0:
+                if outposts_owned > 2*user.city.level:
+                    results.append({'ok': False, 'message': 'You cannot place any more outposts!'})
+                    continue
+                outpost = Outpost(city_id=user.city_id, coord=[x, y], level=1, resources={
+                    "wood": 0, "stone": 0, "iron": 0, "coal": 0})
+                new_outposts.append(outpost)
+                outposts_owned += 1
+                db.session.add(outpost)
+            else:
+                # Outposts placed earlier in the batch count, ones the batch
+                # removes (even later on) do not
+                outpost = nearest_outpost(user.city_id, x, y, exclude=doomed)
+                if outpost is None:
+                    pending = [(abs(o.x - x) + abs(o.y - y), i) for i, o in enumerate(new_outposts)
+                               if abs(o.x - x) <= 20 and abs(o.y - y) <= 10]
+                    if not pending:
+                        results.append({'ok': False, 'message': 'No outpost found within 10 units of this location!'})
+                        continue
+                    outpost = new_outposts[min(pending)[1]]
+                db.session.add(Building(building_id=item.get('id'), level=1, outpost=outpost,
+                                        coord=[x, y], resource=None, rate=None))
+            placed.add((x, y))
+            freed.discard((x, y))
+            results.append({'ok': True})
+        else:
+            results.append({'ok': False, 'message': f'Unknown op {op}!'})
+    return results
+
+
+@app.route('/buildings/batch', methods=['POST'])
+@login_required
+def handle_buildings_batch():
+    items = get_request_data().get('items')
+    if not isinstance(items, list) or not items:
+        return handle_response('items must be a non-empty list!', 400)
+    if len(items) > MAX_BATCH_ITEMS:
+        return handle_response(f'At most {MAX_BATCH_ITEMS} items per batch!', 400)
+    try:
+        results = apply_batch(items, current_user)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return handle_response(f'Error: {e}', 400)
+    return make_response(jsonify({'results': results}), 200)
+
+
 @app.route('/', methods=['GET'])
 def index():
     return handle_response('Hello world!', 200)
 
 
 if __name__ == "__main__":
+    warm_indexes()
     app.run(host='0.0.0.0', port=server_port)
@@ -0,0 +1,164 @@
+import asyncio
+from asgiref.wsgi import WsgiToAsgi
+from flask_login.config import COOKIE_NAME
+from flask_login.utils import decode_cookie
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.wrappers import Request
+from app import app, m, warm_indexes, get_coordinates, get_map_encoding, get_map_detail, get_map_region, within_range, map_payload, check_map_window
+from models import User, Building, Outpost
+from serializers import building_select, outpost_select, rows_to_dicts, BUILDING_FIELDS, OUTPOST_FIELDS
+from services import connection_string, hash_api_key, user_cache, API_KEY_HEADER
+from proc_map.encoding import ENCODINGS
+from stream import handle_stream
+
+# ASGI entry point, run with: uvicorn asgi:application
+# GET /map is served natively so a worker keeps many of them in flight,
+# with chunk reads on a thread pool and the structure queries on pooled
+# asyncpg connections all running at once. The /map/stream WebSocket is
+# served by stream.py. Everything else goes to Flask.
+
+flask_app = WsgiToAsgi(app)
+engine = create_async_engine(connection_string.replace('postgresql://', 'postgresql+asyncpg://', 1),
+                             pool_size=10, max_overflow=20)
+
+
+def scope_request(scope):
+    # Werkzeug request over the ASGI scope, enough for args, headers and cookies
+    environ = {'REQUEST_METHOD': scope.get('method', 'GET'),
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': (scope.get('server') or ('localhost',))[0],
+               'SERVER_PORT': str((scope.get('server') or (None, 80))[1]),
+               'wsgi.url_scheme': scope.get('scheme', 'http')}
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = value.decode('latin-1')
+    return Request(environ)
+
+
+async def fetch_dicts(statement, fields):
+    async with engine.connect() as connection:
+        rows = (await connection.execute(statement)).all()
+    return rows_to_dicts(fields, rows)
+
+
+def session_user_id(req):
+    # As Flask-Login: the session cookie, then the remember-me cookie set by
+    # login_user(remember=True) unless logout_user cleared it
+    session = app.session_interface.open_session(app, req)
+    if session is not None and session.get('_user_id') is not None:
+        return session['_user_id']
+    cookie = req.cookies.get(app.config.get('REMEMBER_COOKIE_NAME', COOKIE_NAME))
+    if not cookie or (session is not None and session.get('_remember') == 'clear'):
+        return None
+    with app.app_context():
+        return decode_cookie(cookie)
+
+
+async def load_user(req):
+    """
+    Return (user_id, position) for the X-API-Key header or the Flask-Login
+    session or remember-me cookie, from the user cache when possible, or
+    None.
+    """
+    if api_key := req.headers.get(API_KEY_HEADER):
+        key_hash = hash_api_key(api_key)
+        key, criteria = ('key', key_hash), User.api_key_hash == key_hash
+    else:
+        try:
+            user_id = int(session_user_id(req))
+        except (TypeError, ValueError):
+            return None
+        key, criteria = ('id', user_id), User.id == user_id
+
+    if snapshot := user_cache.get(key):
+        return snapshot['id'], snapshot['position']
+    async with engine.connect() as connection:
+        row = (await connection.execute(select(*User.__table__.columns).where(criteria))).first()
+    if row is None:
+        return None
+    # Cached like the Flask loaders, so the next request skips the query
+    user_cache.put(key, row)
+    return row.id, row.position
+
+
+def dumps(payload):
+    return app.json.dumps(payload, separators=(',', ':'))
+
+
+async def send_json(send, payload, status, headers=()):
+    body = dumps(payload).encode()
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_map(scope, receive, send):
+    req = scope_request(scope)
+    user = await load_user(req)
+    if user is None:
+        return await send_json(send, {'message': 'Not logged in!'}, 401)
+
+    x, y, r = get_coordinates(req, *user)
+    encoding = get_map_encoding(req)
+    if encoding not in ENCODINGS:
+        return await send_json(send, {'message': f'Unknown map encoding {encoding}!'}, 400)
+    try:
+        layers, lod = get_map_detail(req)
+    except ValueError as e:
+        return await send_json(send, {'message': f'Invalid map detail: {e}!'}, 400)
+    if not m.level_available(lod):
+        return await send_json(send, {'message': f'Map level {lod} has not been built yet!'}, 503)
+
+    loop = asyncio.get_running_loop()
+    # May generate chunks, so off the event loop
+    if error := await loop.run_in_executor(None, check_map_window, x, y, r, lod):
+        message, status = error
+        return await send_json(send, {'message': message}, status)
+    region, buildings, outposts = await asyncio.gather(
+        loop.run_in_executor(None, get_map_region, x, y, r, layers, lod),
+        fetch_dicts(building_select(*within_range(Building, x, y, r)), BUILDING_FIELDS),
+        fetch_dicts(outpost_select(*within_range(Outpost, x, y, r)), OUTPOST_FIELDS))
+    await send_json(send, map_payload(x, y, lod, layers, encoding, region, buildings, outposts),
+                    200, [(b'vary', b'Accept, Cookie')])
+
+
+async def stream_map(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    req = scope_request(scope)
+    if await load_user(req) is None:
+        return await send({'type': 'websocket.close', 'code': 4401})
+    await send({'type': 'websocket.accept'})
+    await handle_stream(req, receive, send, fetch_dicts, dumps)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.get_running_loop().run_in_executor(None, warm_indexes)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(scope, receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/map':
+        return await handle_map(scope, receive, send)
+    if scope['type'] == 'websocket':
+        if scope['path'] == '/map/stream':
+            return await stream_map(scope, receive, send)
+        return await send({'type': 'websocket.close', 'code': 4404})
+    return await flask_app(scope, receive, send)
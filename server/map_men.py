@@ -1,7 +1,10 @@
+import argparse
 import cmd
+from dotenv import load_dotenv
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from proc_map import Map, write_profiles_to_file
+from proc_map import Map, world_params, write_profiles_to_file
+from proc_map.world_store import convert_pickled_chunks
 
 resources = {
     'Stone': {'stage': [0.7, 0.15, 0, 0.05], 'color': 'gray', 'id': 0},
@@ -42,14 +45,43 @@ class Menu(cmd.Cmd):
         self.map.assign_resources_to_samples()
 
     def do_map(self, args):
-        """Generate map"""
+        """Generate map. Arguments: [workers] [verify] [grid|kdtree]"""
+        args = args.split()
+        workers = int(args[0]) if args else None
+        verify = 'verify' in args[1:]
+        engine = 'kdtree' if 'kdtree' in args[1:] else 'grid'
         print("Generating map...")
-        self.map.generate_map()
+        self.map.generate_map(workers=workers, verify=verify, engine=engine)
+
+    def do_build(self, args):
+        """Build all chunks, resuming from the manifest. Arguments: [workers]"""
+        workers = int(args) if args.strip() else None
+        self.map.build_world(workers=workers)
+
+    def do_stream(self, args):
+        """Build the world band by band, resuming from the manifest. Arguments: [band_chunks]"""
+        band_chunks = int(args) if args.strip() else 1
+        self.map.stream_world(band_chunks=band_chunks)
+
+    def do_pyramid(self, args):
+        """Build the coarse levels of detail from a complete level 0"""
+        self.map.build_pyramid()
+
+    def do_sites(self, args):
+        """Save the deposit sites of the per-chunk pipeline, for worlds served lazily"""
+        self.map.save_sites()
 
     def do_generate_chunks(self, args):
         """Generate chunks"""
         self.map.generate_chunks()
 
+    def do_convert_chunks(self, args):
+        """Convert pickled chunks into the world store. Arguments: [chunk_dir]"""
+        chunk_dir = args.strip() or './proc_map/chunks'
+        store = self.map.create_store()
+        converted = convert_pickled_chunks(chunk_dir, store)
+        print(f"Converted {converted} chunks into {store.path}.")
+
     def do_quit(self, args):
         """Quit the program."""
         print("Quitting.")
@@ -99,6 +131,20 @@ class Menu(cmd.Cmd):
         return True
 
 
+def parse_world_args():
+    # World parameters default to the shared WORLD_* settings the server also
+    # reads; a world built with other values needs them set for the server too
+    params = world_params()
+    parser = argparse.ArgumentParser(description="Build and inspect the world.")
+    parser.add_argument('--height', type=int, default=params['height'])
+    parser.add_argument('--width', type=int, default=params['width'])
+    parser.add_argument('--chunk-size', type=int, default=params['chunk_size'])
+    parser.add_argument('--seed', type=int, default=params['seed'])
+    parser.add_argument('--store', dest='store_path', default=params['store_path'])
+    return vars(parser.parse_args())
+
+
 if __name__ == '__main__':
-    m = Map(seed=14453)
+    load_dotenv()
+    m = Map(**parse_world_args())
     Menu(m).cmdloop()
@@ -0,0 +1,22 @@
+from sqlalchemy import text
+from services import app, hash_api_key
+from models import db, User
+
+# Adds the api_key_hash column and fills it by decrypting every stored key.
+# Safe to run more than once.
+
+
+def migrate():
+    db.session.execute(text(
+        "alter table users add column if not exists api_key_hash varchar(64)"))
+    db.session.execute(text(
+        "create unique index if not exists uq_users_api_key_hash on users (api_key_hash)"))
+    users = User.query.filter(User.api_key_hash.is_(None)).all()
+    for user in users:
+        user.api_key_hash = hash_api_key(user.get_key())
+    db.session.commit()
+    print(f"Hashed API keys of {len(users)} users.")
+
+
+with app.app_context():
+    migrate()
@@ -0,0 +1,38 @@
+from sqlalchemy import text
+from services import app
+from models import db, Outpost, Building
+
+# Recreates the outpost and building foreign keys with ON DELETE CASCADE,
+# indexes them, and removes buildings orphaned by earlier outpost deletes.
+# Safe to run more than once.
+
+FOREIGN_KEYS = [
+    ('buildings', 'outpost_id', 'outposts'),
+    ('outposts', 'city_id', 'cities'),
+]
+
+
+def migrate():
+    orphans = db.session.execute(text(
+        "delete from buildings where outpost_id is null or outpost_id not in (select id from outposts)"))
+    print(f"Deleted {orphans.rowcount} orphaned buildings.")
+    orphans = db.session.execute(text(
+        "delete from outposts where city_id is null or city_id not in (select id from cities)"))
+    print(f"Deleted {orphans.rowcount} orphaned outposts.")
+
+    for table, column, referred in FOREIGN_KEYS:
+        name = f'fk_{table}_{column}_{referred}'
+        db.session.execute(text(
+            f"alter table {table} drop constraint if exists {name}"))
+        db.session.execute(text(
+            f"alter table {table} add constraint {name} foreign key ({column}) references {referred} (id) on delete cascade"))
+    db.session.commit()
+
+    # Cascades look up children by these columns
+    for model in (Outpost, Building):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+with app.app_context():
+    migrate()
@@ -0,0 +1,78 @@
+import re
+from sqlalchemy import text
+from services import app
+from models import db, Outpost, Building
+
+# Adds the integer x/y columns and their indexes to an existing database and
+# fills them from the JSON coord column, then checks with EXPLAIN that the
+# lookups use them. Safe to run more than once.
+
+# Lookups /map and the placement handlers make, each with the indexes
+# EXPLAIN has to show it using
+EXPLAIN_QUERIES = [
+    ("select * from outposts where x = 0 and y = 0",
+     ('ix_outposts_x_y',)),
+    ("select * from buildings where x = 0 and y = 0",
+     ('ix_buildings_x_y',)),
+    ("select * from outposts where x between -50 and 50 and y between -50 and 50",
+     ('ix_outposts_x_y',)),
+    ("select * from buildings where x between -50 and 50 and y between -50 and 50",
+     ('ix_buildings_x_y',)),
+    ("select * from outposts where city_id = 1 and x between -20 and 20 and y between -10 and 10",
+     ('ix_outposts_city_id_x_y', 'ix_outposts_x_y')),
+]
+
+
+def migrate():
+    for model in (Outpost, Building):
+        table = model.__tablename__
+        db.session.execute(text(
+            f"alter table {table} add column if not exists x integer, add column if not exists y integer"))
+        updated = db.session.execute(text(
+            f"update {table} set x = (coord->>0)::int, y = (coord->>1)::int where coord is not null and (x is null or y is null)"))
+        print(f"Filled x/y for {updated.rowcount} rows of {table}.")
+    db.session.commit()
+
+    for model in (Outpost, Building):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Fresh statistics so the planner knows about the new indexes
+    db.session.execute(text("analyze outposts"))
+    db.session.execute(text("analyze buildings"))
+    db.session.commit()
+
+
+# "Index Scan using ix", "Index Only Scan using ix" or "Bitmap Index Scan on ix"
+INDEX_SCAN = re.compile(r'Index (?:Only )?Scan (?:Backward )?using (\w+)|Bitmap Index Scan on (\w+)')
+
+
+def uses_index(plan, indexes):
+    return any(name in indexes
+               for line in plan for match in INDEX_SCAN.finditer(line)
+               for name in match.groups() if name)
+
+
+def explain():
+    """
+    EXPLAIN every lookup with sequential scans disabled, so even a tiny
+    table shows whether the planner can use an index for it, and fail
+    unless each plan uses one of its indexes.
+    """
+    failed = []
+    db.session.execute(text("set local enable_seqscan = off"))
+    for query, indexes in EXPLAIN_QUERIES:
+        plan = db.session.execute(text(f"explain {query}")).scalars().all()
+        ok = uses_index(plan, indexes)
+        print(f"{'ok' if ok else 'NO INDEX'}: {query}")
+        for line in plan:
+            print(f"    {line}")
+        if not ok:
+            failed.append(query)
+    db.session.rollback()
+    if failed:
+        raise SystemExit(f"{len(failed)} lookups do not use their index: {failed}")
+
+
+with app.app_context():
+    migrate()
+    explain()
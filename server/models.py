@@ -1,3 +1,4 @@
+import hmac
 import secrets
 import uuid
 import re
@@ -6,7 +7,7 @@ from sqlalchemy import event
 from sqlalchemy.orm import validates
 from sqlalchemy.dialects.postgresql import UUID, JSON, ARRAY
 from sqlalchemy.ext.mutable import MutableList
-from services import db, bcrypt, cipher_suite
+from services import db, bcrypt, cipher_suite, hash_api_key, user_cache
 from sqlalchemy_serializer import SerializerMixin
 from flask_login import UserMixin
 
@@ -18,6 +19,8 @@ class User(UserMixin, db.Model, SerializerMixin):
     username = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(), nullable=False)
     api_key = db.Column(db.String, unique=True, nullable=False)
+    # HMAC of the plain key, looked up by the X-API-Key request loader
+    api_key_hash = db.Column(db.String(64), unique=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     city_id = db.Column(db.Integer, db.ForeignKey('cities.id'))
     position = db.Column(JSON)
@@ -47,7 +50,7 @@ class User(UserMixin, db.Model, SerializerMixin):
         if password:
             return bcrypt.check_password_hash(self.password, password)
         elif api_key:
-            return self.api_key == api_key
+            return hmac.compare_digest(self.api_key_hash or '', hash_api_key(api_key))
 
     def get_key(self):
         return cipher_suite.decrypt(self.api_key.encode()).decode()
@@ -62,6 +65,13 @@ def handle_security(mapper, connection, target):
     api_key = secrets.token_hex(16).encode()
     encrypted_key = cipher_suite.encrypt(api_key)
     target.api_key = encrypted_key.decode()
+    target.api_key_hash = hash_api_key(api_key.decode())
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
 
 
 class City(db.Model, SerializerMixin):
@@ -72,30 +82,53 @@ class City(db.Model, SerializerMixin):
     name = db.Column(db.String(120), nullable=False)
     level = db.Column(db.Integer)
     users = db.relationship('User', backref='city', lazy=True)
-    outposts = db.relationship('Outpost', backref='city', lazy=True)
+    # Outposts and their buildings go with the city, deleted by the database
+    outposts = db.relationship('Outpost', backref='city', lazy=True,
+                               cascade='all, delete-orphan', passive_deletes=True)
+
 
+class CoordMixin:
+    # coord stays the serialized [x, y]; x and y mirror it as indexed integers
+    x = db.Column(db.Integer)
+    y = db.Column(db.Integer)
 
-class Outpost(db.Model, SerializerMixin):
+    @validates('coord')
+    def validate_coord(self, key, coord):
+        self.x, self.y = int(coord[0]), int(coord[1])
+        return coord
+
+
+class Outpost(CoordMixin, db.Model, SerializerMixin):
     __tablename__ = 'outposts'
     serialize_rules = ('-city',)
+    __table_args__ = (
+        db.Index('ix_outposts_x_y', 'x', 'y'),
+        db.Index('ix_outposts_city_id_x_y', 'city_id', 'x', 'y'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    city_id = db.Column(db.Integer, db.ForeignKey('cities.id'))
+    city_id = db.Column(db.Integer, db.ForeignKey(
+        'cities.id', ondelete='CASCADE'), index=True)
     coord = db.Column(JSON)
     level = db.Column(db.Integer)
     resources = db.Column(JSON)
     # Update relationship name
-    buildings = db.relationship('Building', backref='outpost', lazy=True)
+    buildings = db.relationship('Building', backref='outpost', lazy=True,
+                                cascade='all, delete-orphan', passive_deletes=True)
 
 
-class Building(db.Model, SerializerMixin):
+class Building(CoordMixin, db.Model, SerializerMixin):
     __tablename__ = 'buildings'
     serialize_rules = ('-outpost',)
+    __table_args__ = (
+        db.Index('ix_buildings_x_y', 'x', 'y'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     building_id = db.Column(db.Integer)
     level = db.Column(db.Integer)
-    outpost_id = db.Column(db.Integer, db.ForeignKey('outposts.id'))
+    outpost_id = db.Column(db.Integer, db.ForeignKey(
+        'outposts.id', ondelete='CASCADE'), index=True)
     coord = db.Column(JSON)
     resource = db.Column(db.String(120))
     rate = db.Column(db.Integer)
@@ -0,0 +1,392 @@
+import json
+import os
+import select
+import threading
+import uuid
+import psycopg2
+from sqlalchemy import event, inspect, func, tuple_
+from sqlalchemy import select as sql_select
+from sqlalchemy.orm import Session
+from models import db, City, Outpost, Building, CoordMixin
+
+# Indexes kept in step with committed Outpost/Building rows
+_indexes = []
+
+# Postgres channel every process announces its committed placements on,
+# and the most changes sent per notification (payloads are capped at 8000
+# bytes)
+CHANNEL = 'placements'
+NOTIFY_BATCH = 100
+_origin = uuid.uuid4().hex
+
+
+def origin():
+    # Marks this process's own notifications. The pid tells apart workers
+    # forked after import
+    return f'{_origin}-{os.getpid()}'
+
+
+def register(index):
+    _indexes.append(index)
+    return index
+
+
+def _placement(obj, x, y, delta):
+    return obj.__tablename__, obj.id, getattr(obj, 'city_id', None), x, y, delta
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_cascades(session, flush_context, instances):
+    # Rows removed by ON DELETE CASCADE never reach the session, so they are
+    # looked up while they still exist
+    outpost_ids = [obj.id for obj in session.deleted if isinstance(obj, Outpost)]
+    city_ids = [obj.id for obj in session.deleted if isinstance(obj, City)]
+    if not outpost_ids and not city_ids:
+        return
+    changes = session.info.setdefault('placements', [])
+    with session.no_autoflush:
+        outposts = session.query(Outpost.id, Outpost.city_id, Outpost.x, Outpost.y).filter(
+            Outpost.city_id.in_(city_ids)).all()
+        outpost_ids += [outpost_id for outpost_id, _, _, _ in outposts]
+        buildings = session.query(Building.id, Building.x, Building.y).filter(
+            Building.outpost_id.in_(outpost_ids)).all()
+    changes += [('outposts', outpost_id, city_id, x, y, -1)
+                for outpost_id, city_id, x, y in outposts]
+    changes += [('buildings', building_id, None, x, y, -1)
+                for building_id, x, y in buildings]
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_placements(session, flush_context):
+    # Changes are only staged here, indexes see them once the commit lands.
+    # Each is (table, id, city_id, x, y, +1 placed / -1 removed), kept in
+    # flush order. Removing the same row twice is harmless.
+    changes = session.info.setdefault('placements', [])
+    for obj in session.new:
+        if isinstance(obj, CoordMixin):
+            changes.append(_placement(obj, obj.x, obj.y, 1))
+    for obj in session.deleted:
+        if isinstance(obj, CoordMixin):
+            changes.append(_placement(obj, obj.x, obj.y, -1))
+    for obj in session.dirty:
+        if not isinstance(obj, CoordMixin):
+            continue
+        x, y = inspect(obj).attrs.x.history, inspect(obj).attrs.y.history
+        if x.has_changes() or y.has_changes():
+            old_x = x.deleted[0] if x.deleted else obj.x
+            old_y = y.deleted[0] if y.deleted else obj.y
+            changes.append(_placement(obj, old_x, old_y, -1))
+            changes.append(_placement(obj, obj.x, obj.y, 1))
+    # Sent inside the transaction, so other processes hear of the changes
+    # only once it commits, and never if it rolls back
+    sent = session.info.get('notified', 0)
+    for start in range(sent, len(changes), NOTIFY_BATCH):
+        payload = json.dumps({'origin': origin(), 'changes': changes[start:start + NOTIFY_BATCH]})
+        session.connection().execute(sql_select(func.pg_notify(CHANNEL, payload)))
+    session.info['notified'] = len(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_placements(session):
+    changes = session.info.pop('placements', [])
+    session.info.pop('notified', None)
+    for index in _indexes:
+        index.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_placements(session):
+    session.info.pop('placements', None)
+    session.info.pop('notified', None)
+
+
+def lock_tiles(session, coords):
+    """
+    Take a transaction-level advisory lock on each tile, in sorted order so
+    two batches can't deadlock. Placements on one tile from any process are
+    serialized until the holder commits or rolls back, so a check made
+    under the lock sees every earlier placement there.
+    """
+    for x, y in sorted(set(coords)):
+        session.execute(sql_select(func.pg_advisory_xact_lock(x, y)))
+
+
+def occupied_tiles(session, coords):
+    # The tiles among coords holding an outpost or building in the database
+    coords = list(set(coords))
+    if not coords:
+        return set()
+    taken = set()
+    for model in (Outpost, Building):
+        taken.update(session.query(model.x, model.y).filter(
+            tuple_(model.x, model.y).in_(coords)).all())
+    return taken
+
+
+class PlacementIndex:
+    """
+    In-memory view of committed placements, loaded from the database by
+    warm() and updated after every commit that places or removes one.
+    Changes committed while a snapshot loads are queued and replayed onto
+    it, so a warm or reconcile racing a commit never loses that commit.
+    Subclasses provide snapshot(), update(state, changes) and entries(state).
+    """
+
+    def __init__(self):
+        self.state = None
+        self.lock = threading.Lock()
+        # Serializes warm/reconcile; apply() only ever takes self.lock
+        self.refresh_lock = threading.Lock()
+        self.pending = None
+        self.warmed = False
+
+    def refresh(self):
+        # Replace the state with a fresh snapshot, returning the old one
+        with self.refresh_lock:
+            with self.lock:
+                self.pending = []
+            try:
+                state = self.snapshot()
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                raise
+            with self.lock:
+                for changes in self.pending:
+                    self.update(state, changes)
+                self.pending = None
+                old, self.state = self.state, state
+                self.warmed = True
+        return old
+
+    def warm(self):
+        self.refresh()
+
+    def ensure_warm(self):
+        # A request arriving during a warm waits for it instead of loading
+        # a second snapshot
+        if not self.warmed:
+            with self.refresh_lock:
+                warmed = self.warmed
+            if not warmed:
+                self.warm()
+
+    def apply(self, changes):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(changes)
+            if self.warmed:
+                self.update(self.state, changes)
+
+    def reconcile(self, repair=True):
+        """
+        Compare the index with the database. Returns the entries missing
+        from the index and the stale ones the database no longer holds;
+        with repair=True the index is replaced by the database's view.
+        """
+        if repair:
+            old = self.refresh()
+            with self.lock:
+                expected = self.entries(self.state)
+        else:
+            expected = self.entries(self.snapshot())
+            with self.lock:
+                old = self.state
+        indexed = self.entries(old) if old is not None else set()
+        missing, stale = list(expected - indexed), list(indexed - expected)
+        if old is not None and (missing or stale):
+            print(f"{type(self).__name__} drifted: {len(missing)} missing, {len(stale)} stale.")
+        return {'missing': missing, 'stale': stale}
+
+
+class OccupancyIndex(PlacementIndex):
+    """
+    Tiles holding an outpost or building, each mapped to the rows on it.
+    """
+
+    def snapshot(self):
+        tiles = {}
+        for model in (Outpost, Building):
+            for row_id, x, y in db.session.query(model.id, model.x, model.y).filter(
+                    model.x.isnot(None)).all():
+                tiles.setdefault((x, y), set()).add((model.__tablename__, row_id))
+        return tiles
+
+    def update(self, tiles, changes):
+        for table, row_id, _, x, y, delta in changes:
+            if delta > 0:
+                tiles.setdefault((x, y), set()).add((table, row_id))
+            elif (x, y) in tiles:
+                tiles[(x, y)].discard((table, row_id))
+                if not tiles[(x, y)]:
+                    del tiles[(x, y)]
+
+    def entries(self, tiles):
+        return set(tiles)
+
+    def warm(self):
+        self.refresh()
+        print(f"Occupancy index warmed with {len(self.state)} tiles.")
+
+    def is_occupied(self, x, y):
+        self.ensure_warm()
+        with self.lock:
+            return (x, y) in self.state
+
+
+class OutpostIndex(PlacementIndex):
+    """
+    Outposts of every city bucketed on a coarse grid, for proximity rules
+    such as finding the outpost a new building belongs to.
+    """
+
+    def __init__(self, bucket_size=32):
+        super().__init__()
+        self.bucket_size = bucket_size
+
+    def bucket(self, x, y):
+        return x // self.bucket_size, y // self.bucket_size
+
+    def snapshot(self):
+        # city_id -> (bucket_x, bucket_y) -> {outpost_id: (x, y)}
+        cities = {}
+        for outpost_id, city_id, x, y in db.session.query(
+                Outpost.id, Outpost.city_id, Outpost.x, Outpost.y).filter(Outpost.x.isnot(None)).all():
+            buckets = cities.setdefault(city_id, {})
+            buckets.setdefault(self.bucket(x, y), {})[outpost_id] = (x, y)
+        return cities
+
+    def update(self, cities, changes):
+        for table, outpost_id, city_id, x, y, delta in changes:
+            if table != Outpost.__tablename__:
+                continue
+            buckets = cities.setdefault(city_id, {})
+            if delta > 0:
+                buckets.setdefault(self.bucket(x, y), {})[outpost_id] = (x, y)
+            else:
+                buckets.get(self.bucket(x, y), {}).pop(outpost_id, None)
+
+    def entries(self, cities):
+        return {(outpost_id, city_id, x, y)
+                for city_id, buckets in cities.items()
+                for bucket in buckets.values()
+                for outpost_id, (x, y) in bucket.items()}
+
+    def within(self, city_id, x, y, dx, dy):
+        """
+        Return (outpost_id, x, y) for every outpost of city_id with
+        |x - outpost x| <= dx and |y - outpost y| <= dy.
+        """
+        self.ensure_warm()
+        min_bx, min_by = self.bucket(x - dx, y - dy)
+        max_bx, max_by = self.bucket(x + dx, y + dy)
+        found = []
+        with self.lock:
+            buckets = self.state.get(city_id, {})
+            for bx in range(min_bx, max_bx + 1):
+                for by in range(min_by, max_by + 1):
+                    for outpost_id, (ox, oy) in buckets.get((bx, by), {}).items():
+                        if abs(ox - x) <= dx and abs(oy - y) <= dy:
+                            found.append((outpost_id, ox, oy))
+        return found
+
+
+class PlacementListener:
+    """
+    Applies placements committed by other server processes to this one's
+    registered indexes and feeds, as Postgres delivers them on CHANNEL, on
+    a daemon thread.
+    Notifications arrive in commit order. Changes committed while the
+    listener was not connected are never delivered, so it calls on_connect
+    (a reconcile) each time it starts listening.
+    """
+
+    def __init__(self, dsn, on_connect=None, timeout=5.0):
+        self.dsn = dsn
+        self.on_connect = on_connect
+        self.timeout = timeout
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def receive(self, payload):
+        message = json.loads(payload)
+        if message['origin'] == origin():
+            # Applied when this process committed it
+            return
+        changes = [tuple(change) for change in message['changes']]
+        # Every registered index, as for a local commit, so live feeds
+        # see other processes' placements too
+        for index in _indexes:
+            index.apply(changes)
+
+    def listen(self, connection):
+        connection.autocommit = True
+        connection.cursor().execute(f'LISTEN {CHANNEL}')
+        if self.on_connect:
+            try:
+                self.on_connect()
+            except Exception as e:
+                print(f"Index reconcile failed: {e}")
+        while not self.stop_event.is_set():
+            if select.select([connection], [], [], self.timeout)[0]:
+                connection.poll()
+                while connection.notifies:
+                    self.receive(connection.notifies.pop(0).payload)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                connection = psycopg2.connect(self.dsn)
+            except psycopg2.Error as e:
+                print(f"Placement listener could not connect: {e}")
+                self.stop_event.wait(self.timeout)
+                continue
+            try:
+                self.listen(connection)
+            except Exception as e:
+                print(f"Placement listener disconnected: {e}")
+                self.stop_event.wait(self.timeout)
+            finally:
+                connection.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class Reconciler:
+    """
+    Reconciles every warmed index with the database every interval seconds
+    on a daemon thread. Other processes' placements normally arrive through
+    the PlacementListener; this repairs anything it missed.
+    """
+
+    def __init__(self, app, interval=600.0):
+        self.app = app
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def reconcile(self):
+        with self.app.app_context():
+            for index in _indexes:
+                # An index nobody has warmed loads a fresh snapshot anyway
+                if isinstance(index, PlacementIndex) and index.warmed:
+                    index.reconcile()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Index reconcile failed: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
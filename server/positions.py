@@ -0,0 +1,104 @@
+import atexit
+import threading
+import time
+from sqlalchemy import update
+from models import db, User
+from services import user_cache
+
+
+class PositionBuffer:
+    """
+    Latest unwritten position of every player, written to users.position in
+    batches every flush_interval seconds and on shutdown instead of once per
+    move.
+    A record() finding a change older than max_staleness wakes the flusher
+    thread early; requests never write or wait on the database themselves.
+    """
+
+    def __init__(self, app, flush_interval=5.0, max_staleness=30.0):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.positions = {}
+        # user_id -> time of the oldest change not yet written
+        self.dirty = {}
+        self.lock = threading.Lock()
+        # One flush at a time, so an older batch never commits after a newer one
+        self.flush_lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get(self, user_id):
+        with self.lock:
+            return self.positions.get(user_id)
+
+    def record(self, user_id, position):
+        now = time.monotonic()
+        with self.lock:
+            self.positions[user_id] = position
+            self.dirty.setdefault(user_id, now)
+            # dirty is filled in time order, so its first entry is the oldest
+            stale = now - next(iter(self.dirty.values())) > self.max_staleness
+        if stale:
+            self.wake_event.set()
+
+    def forget(self, user_id):
+        with self.lock:
+            self.positions.pop(user_id, None)
+            self.dirty.pop(user_id, None)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending = [{'id': user_id, 'position': self.positions[user_id]}
+                           for user_id in self.dirty]
+                self.dirty = {}
+            if not pending:
+                return 0
+            try:
+                with self.app.app_context():
+                    # One executemany UPDATE keyed on the primary key
+                    db.session.execute(update(User), pending)
+                    db.session.commit()
+            except Exception:
+                # Keep the positions for the next flush unless newer ones arrived
+                now = time.monotonic()
+                with self.lock:
+                    for row in pending:
+                        self.dirty.setdefault(row['id'], now)
+                raise
+            for row in pending:
+                user_cache.invalidate(row['id'])
+            # Written positions are dropped unless moved again meanwhile, so
+            # reads fall back to the row, which other workers may update
+            with self.lock:
+                for row in pending:
+                    if row['id'] not in self.dirty:
+                        self.positions.pop(row['id'], None)
+        return len(pending)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.wake_event.wait(self.flush_interval)
+            self.wake_event.clear()
+            if self.stop_event.is_set():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Position flush failed: {e}")
+                # Back off rather than retry on every stale record()
+                self.stop_event.wait(self.flush_interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
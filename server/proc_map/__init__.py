@@ -1 +1,2 @@
-from proc_map.map import Map, write_profiles_to_file
\ No newline at end of file
+from proc_map.map import Map, write_profiles_to_file
+from proc_map.config import world_params
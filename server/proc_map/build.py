@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import tqdm
+from proc_map.deposits import load_sites
+
+# Map of the current worker process, set up once by _init_worker
+_worker_map = None
+
+
+def chunk_checksum(chunk):
+    return hashlib.sha256(np.ascontiguousarray(chunk).tobytes()).hexdigest()
+
+
+def manifest_path_for(store_path):
+    return f'{os.path.splitext(store_path)[0]}.manifest.json'
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # Replace the manifest atomically so a crash never leaves it truncated
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(params, store_path, saved_samples=True):
+    global _worker_map
+    from proc_map.map import Map  # Import here to avoid circular import
+    _worker_map = Map(**params, lazy=True,
+                      store_path=store_path, cache_entries=0)
+    if saved_samples:
+        _worker_map.load_chunk_samples()
+
+
+def _sample_chunk(chunk_row, chunk_col):
+    # Nothing is kept, each chunk is sampled exactly once
+    samples = _worker_map.get_chunk_samples(chunk_row, chunk_col)
+    del _worker_map.chunk_samples_cache[(chunk_row, chunk_col)]
+    return samples
+
+
+def _build_chunk(chunk_row, chunk_col):
+    chunk = _worker_map.generate_chunk(chunk_row, chunk_col)
+    return chunk_row, chunk_col, chunk_checksum(chunk)
+
+
+def open_build(map_object, manifest_path=None):
+    """
+    Load (or start) the build manifest of map_object's world and open its
+    store for writing. Returns (manifest_path, manifest, store).
+    """
+    params = map_object.params()
+    manifest_path = manifest_path or manifest_path_for(map_object.store_path)
+    manifest = load_manifest(manifest_path)
+
+    if manifest is not None and manifest['params'] != params:
+        raise ValueError(
+            f"{manifest_path} was built with {manifest['params']}, refusing to mix in chunks built with {params}.")
+    if manifest is None:
+        if os.path.exists(map_object.store_path):
+            raise ValueError(
+                f"World store {map_object.store_path} exists without a manifest, refusing to build into it.")
+        manifest = {'params': params, 'chunks': {}}
+
+    # Parent creates (or checks) the store so workers only ever open it
+    store = map_object.open_store(mode='r+', create=True)
+    save_manifest(manifest_path, manifest)
+    return manifest_path, manifest, store
+
+
+def chunk_built(store, manifest, chunk_row, chunk_col):
+    # Recorded in the manifest and the store still matches its checksum
+    checksum = manifest['chunks'].get(f'{chunk_row}_{chunk_col}')
+    return checksum is not None and store.has_chunk(chunk_row, chunk_col) and \
+        chunk_checksum(store.read_chunk(chunk_row, chunk_col)) == checksum
+
+
+def build_world(map_object, workers=None, manifest_path=None):
+    """
+    Generate every chunk of map_object's world into its store, one work item
+    per chunk, optionally on a process pool. Every chunk's samples are drawn
+    once up front and saved as the deposit sites, which the chunk workers
+    then read their neighbours' samples from. Progress is recorded in a
+    manifest holding the Map parameters and a checksum per finished chunk,
+    so an interrupted build picks up where it left off. Returns the manifest.
+    """
+    params = map_object.params()
+    manifest_path, manifest, store = open_build(map_object, manifest_path)
+
+    # Sites saved by the eager generate_map are not per-chunk samples
+    if load_sites(map_object.sites_path(), params, pipeline='chunks') is None:
+        chunks = [(chunk_row, chunk_col)
+                  for chunk_row in range(store.chunk_rows)
+                  for chunk_col in range(store.chunk_cols)]
+        if workers and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(params, map_object.store_path, False)) as executor:
+                samples = list(tqdm.tqdm(executor.map(_sample_chunk, *zip(*chunks), chunksize=8),
+                                         total=len(chunks), desc="Samples"))
+        else:
+            _init_worker(params, map_object.store_path, False)
+            samples = [_sample_chunk(*chunk) for chunk in tqdm.tqdm(chunks, desc="Samples")]
+        map_object.save_sites(np.concatenate([sites for sites, _ in samples]),
+                              np.concatenate([stage_ids for _, stage_ids in samples]))
+        del samples
+
+    # Chunks recorded in the manifest are skipped if the store still matches
+    pending = [(chunk_row, chunk_col)
+               for chunk_row in range(store.chunk_rows)
+               for chunk_col in range(store.chunk_cols)
+               if not chunk_built(store, manifest, chunk_row, chunk_col)]
+    print(f"{len(pending)} of {store.chunk_rows * store.chunk_cols} chunks left to build.")
+
+    def record(chunk_row, chunk_col, checksum):
+        manifest['chunks'][f'{chunk_row}_{chunk_col}'] = checksum
+        save_manifest(manifest_path, manifest)
+
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(params, map_object.store_path)) as executor:
+            futures = [executor.submit(_build_chunk, *chunk)
+                       for chunk in pending]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Chunks"):
+                record(*future.result())
+    else:
+        _init_worker(params, map_object.store_path)
+        for chunk in tqdm.tqdm(pending, desc="Chunks"):
+            record(*_build_chunk(*chunk))
+
+    # Coarse levels are cheap next to the chunks, so they are always rebuilt
+    map_object.build_pyramid()
+    return manifest
+
+
+def stream_world(map_object, band_chunks=1, manifest_path=None):
+    """
+    Generate map_object's world in horizontal bands of band_chunks chunk
+    rows, writing each band's chunks before starting the next. Only the
+    current band, the sample rows around it and the sites spooled to disk
+    are ever held, so worlds larger than memory can be built. Chunks go
+    into the same manifest as build_world and finished bands are skipped.
+    Returns the manifest.
+    """
+    manifest_path, manifest, store = open_build(map_object, manifest_path)
+    sites_path = map_object.sites_path()
+    site_spool, id_spool = f'{sites_path}.sites.tmp', f'{sites_path}.ids.tmp'
+
+    with open(site_spool, 'wb') as site_file, open(id_spool, 'wb') as id_file:
+        for band_start in tqdm.tqdm(range(0, store.chunk_rows, band_chunks), desc="Bands"):
+            band_end = min(band_start + band_chunks, store.chunk_rows)
+            band = [(chunk_row, chunk_col)
+                    for chunk_row in range(band_start, band_end)
+                    for chunk_col in range(store.chunk_cols)]
+            if not all(chunk_built(store, manifest, *chunk) for chunk in band):
+                for chunk_row, chunk_col, chunk in map_object.generate_band(band_start, band_end):
+                    store.write_chunk(chunk_row, chunk_col, chunk)
+                    manifest['chunks'][f'{chunk_row}_{chunk_col}'] = chunk_checksum(chunk)
+                save_manifest(manifest_path, manifest)
+
+            # Deposit sites are spooled in chunk order, as collect_chunk_sites
+            # would gather them
+            for chunk_row, chunk_col in band:
+                sites, stage_ids = map_object.get_chunk_samples(chunk_row, chunk_col)
+                site_file.write(np.ascontiguousarray(sites, dtype=np.int32).tobytes())
+                id_file.write(np.ascontiguousarray(stage_ids, dtype=np.uint8).tobytes())
+            # The next band still needs the samples of this band's last row
+            map_object.drop_chunk_samples(band_end - 1)
+
+    sites = np.memmap(site_spool, dtype=np.int32, mode='r').reshape(-1, 2)
+    stage_ids = np.memmap(id_spool, dtype=np.uint8, mode='r').reshape(-1, 4)
+    map_object.save_sites(sites, stage_ids)
+    del sites, stage_ids
+    os.remove(site_spool)
+    os.remove(id_spool)
+
+    map_object.build_pyramid()
+    return manifest
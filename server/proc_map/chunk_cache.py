@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class ChunkCache:
+    """
+    Thread-safe LRU cache of chunk arrays, bounded by entry count and/or
+    total bytes. A limit of None means unbounded on that axis.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_resident = 0
+
+    def get(self, key):
+        with self.lock:
+            chunk = self.entries.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        # Chunks larger than the whole budget are never cached
+        if self.max_bytes is not None and chunk.nbytes > self.max_bytes:
+            return
+        if self.max_entries == 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes_resident -= self.entries.pop(key).nbytes
+            self.entries[key] = chunk
+            self.bytes_resident += chunk.nbytes
+            while ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+                   (self.max_bytes is not None and self.bytes_resident > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes_resident -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes_resident = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes_resident': self.bytes_resident}
@@ -0,0 +1,12 @@
+import os
+
+# Parameters of the world, shared by map_men (which builds it) and the server
+# (which opens it), so both agree on the store header. Set them in .env
+
+
+def world_params():
+    return dict(height=int(os.getenv('WORLD_HEIGHT') or "5000"),
+                width=int(os.getenv('WORLD_WIDTH') or "5000"),
+                chunk_size=int(os.getenv('WORLD_CHUNK_SIZE') or "500"),
+                seed=int(os.getenv('WORLD_SEED') or "14453"),
+                store_path=os.getenv('WORLD_STORE') or './proc_map/world.bin')
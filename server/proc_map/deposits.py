@@ -0,0 +1,94 @@
+import json
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def save_sites(path, sites, stage_ids, params, pipeline='chunks'):
+    """
+    Persist the Voronoi sample sites, (n, 2) x/y, and their per-stage
+    resource IDs, (n, 4), along with the Map parameters and the pipeline
+    ('chunks' or 'eager') they came from.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    np.savez(path, sites=np.asarray(sites, dtype=np.int32),
+             stage_ids=np.asarray(stage_ids, dtype=np.uint8),
+             params=np.array(json.dumps(params, sort_keys=True)),
+             pipeline=np.array(pipeline))
+
+
+def load_sites(path, params, pipeline=None):
+    # None when the file is missing or was built for another world, or by
+    # another pipeline when one is asked for
+    try:
+        with np.load(path) as data:
+            if json.loads(str(data['params'])) != params:
+                return None
+            if pipeline is not None and ('pipeline' not in data.files or str(data['pipeline']) != pipeline):
+                return None
+            return data['sites'], data['stage_ids']
+    except FileNotFoundError:
+        return None
+
+
+class DepositIndex:
+    """
+    One KD-tree of sample sites per (stage, resource ID), answering nearest
+    and within-radius deposit queries without touching the raster.
+    """
+
+    def __init__(self, sites, stage_ids):
+        self.trees = {}
+        self.sites = {}
+        for stage in range(stage_ids.shape[1]):
+            for resource_id in np.unique(stage_ids[:, stage]):
+                points = sites[stage_ids[:, stage] == resource_id]
+                self.sites[(stage, int(resource_id))] = points
+                self.trees[(stage, int(resource_id))] = cKDTree(points)
+
+    def nearest(self, stage, resource_id, x, y, k=1):
+        """
+        Return up to k (x, y, distance) deposits closest to (x, y).
+        """
+        tree = self.trees.get((stage, resource_id))
+        if tree is None:
+            return []
+        k = min(k, tree.n)
+        distances, indices = tree.query([x, y], k=k)
+        points = self.sites[(stage, resource_id)][np.atleast_1d(indices)]
+        return [(int(px), int(py), float(d))
+                for (px, py), d in zip(points, np.atleast_1d(distances))]
+
+    def within(self, stage, resource_id, x, y, radius, limit=None):
+        """
+        Return (x, y, distance) for every deposit within radius of (x, y),
+        nearest first, keeping at most limit of them.
+        """
+        tree = self.trees.get((stage, resource_id))
+        if tree is None:
+            return []
+        if limit is not None:
+            # Only the nearest `limit` are ever looked at, however large the
+            # radius; nextafter keeps sites exactly on the radius
+            distances, indices = tree.query([x, y], k=min(limit, tree.n),
+                                            distance_upper_bound=np.nextafter(radius, np.inf))
+            distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+            found = indices < tree.n
+            points = self.sites[(stage, resource_id)][indices[found]]
+            return [(int(px), int(py), float(d))
+                    for (px, py), d in zip(points, distances[found])]
+        points = self.sites[(stage, resource_id)][tree.query_ball_point([x, y], radius)]
+        if not len(points):
+            return []
+        distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+        order = np.argsort(distances, kind='stable')[:limit]
+        return [(int(px), int(py), float(d))
+                for (px, py), d in zip(points[order], distances[order])]
+
+
+def chunk_histogram(chunk, n_resources, stages=4):
+    # Tiles per resource ID for every stage layer of a chunk, (stages, n_resources)
+    return np.stack([np.bincount(chunk[..., stage].ravel(), minlength=n_resources)[:n_resources]
+                     for stage in range(stages)])
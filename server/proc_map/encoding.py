@@ -0,0 +1,66 @@
+import base64
+import numpy as np
+
+# Encodings for region arrays returned by Map.get_region. Every encoding
+# other than 'json' works per layer plane, flattened in row-major order.
+ENCODINGS = ('json', 'planes', 'rle')
+
+
+def layer_planes(region):
+    # (rows, cols, layers) -> one (rows, cols) plane per layer
+    if region.ndim == 2:
+        return [region]
+    return [region[..., layer] for layer in range(region.shape[2])]
+
+
+def run_lengths(plane):
+    flat = np.ascontiguousarray(plane).ravel()
+    if not len(flat):
+        return [], []
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    lengths = np.diff(np.append(starts, len(flat)))
+    return flat[starts].tolist(), lengths.tolist()
+
+
+def encode_region(region, encoding='json'):
+    """
+    Encode a region for a JSON response.
+      json   nested lists, [y][x][layer]
+      planes base64 of each layer's raw bytes
+      rle    (values, lengths) runs for each layer
+    """
+    if encoding == 'json':
+        return region.tolist()
+
+    data = {'encoding': encoding,
+            'shape': list(region.shape),
+            'dtype': region.dtype.name}
+    if encoding == 'planes':
+        data['layers'] = [base64.b64encode(np.ascontiguousarray(plane).tobytes()).decode()
+                          for plane in layer_planes(region)]
+    elif encoding == 'rle':
+        data['layers'] = [dict(zip(('values', 'lengths'), run_lengths(plane)))
+                          for plane in layer_planes(region)]
+    else:
+        raise ValueError(f"Unknown map encoding {encoding}.")
+    return data
+
+
+def decode_region(data):
+    """
+    Inverse of encode_region.
+    """
+    if isinstance(data, list):
+        return np.array(data)
+
+    shape, dtype = tuple(data['shape']), np.dtype(data['dtype'])
+    plane_shape = shape[:2]
+    if data['encoding'] == 'planes':
+        planes = [np.frombuffer(base64.b64decode(layer), dtype=dtype).reshape(plane_shape)
+                  for layer in data['layers']]
+    elif data['encoding'] == 'rle':
+        planes = [np.repeat(np.array(layer['values'], dtype=dtype), layer['lengths']).reshape(plane_shape)
+                  for layer in data['layers']]
+    else:
+        raise ValueError(f"Unknown map encoding {data['encoding']}.")
+    return planes[0] if len(shape) == 2 else np.stack(planes, axis=-1)
@@ -1,8 +1,6 @@
 import cmd
 import numpy as np
-from noise import snoise2
 import os
-import pickle
 from scipy.spatial import Voronoi, voronoi_plot_2d, cKDTree
 import tqdm
 import cProfile
@@ -10,15 +8,28 @@ import pstats
 import io
 from collections import defaultdict
 import time
+import threading
 import matplotlib.pyplot as plt
 
 from proc_map.poisson_points import poisson_disc_samples
+from proc_map.noise_field import generate_noise_field, verify_noise_field, noise_chunk
 from proc_map.resources import resources, overworld
+from proc_map.world_store import WorldStore
+from proc_map.chunk_cache import ChunkCache
+from proc_map.build import build_world, stream_world
+from proc_map.pyramid import downsample_mode
+from proc_map.voronoi_labels import label_bands, nearest_sites, SiteGrid
+from proc_map.deposits import DepositIndex, save_sites, load_sites, chunk_histogram
 # from poisson_points import poisson_disc_samples
 # from resources import resources, overworld
 
 profile_data = defaultdict(list)
 
+# Every layer value (resource or terrain ID) fits in a byte
+LAYER_DTYPE = np.uint8
+# 5 layers: 4 stages + 1 Perlin
+LAYERS = 5
+
 
 def profile(func):
     def wrapper(*args, **kwargs):
@@ -51,7 +62,8 @@ def write_profiles_to_file():
 
 
 class Map:
-    def __init__(self, height=5000, width=5000, chunk_size=500, r=5, frequency=200, octaves=6, persistence=0.5, lacunarity=2, seed=69420):
+    def __init__(self, height=5000, width=5000, chunk_size=500, r=5, frequency=200, octaves=6, persistence=0.5, lacunarity=2, seed=69420,
+                 lazy=False, sample_margin=50, store_path='./proc_map/world.bin', cache_entries=32, cache_bytes=None, max_lod=4):
         self.height = height
         self.width = width
         self.chunk_size = chunk_size
@@ -63,6 +75,24 @@ class Map:
         self.seed = seed
         self.samples = None
         self.sample_resources = None
+        # In lazy mode missing chunks are generated on first access instead
+        # of requiring a full generate_map run
+        self.lazy = lazy
+        self.sample_margin = sample_margin
+        self.store_path = store_path
+        self._stores = {}
+        self._deposits = None
+        # Level of detail pyramid: level n is the world downsampled 2**n times
+        self.max_lod = max_lod
+        # Recently used chunks are kept in memory, bounded by entry count
+        # and/or bytes
+        self.chunk_cache = ChunkCache(cache_entries, cache_bytes)
+        self.chunk_samples_cache = {}
+        # One lock per chunk being generated, so requests for different
+        # chunks generate them in parallel
+        self.chunk_locks = {}
+        self.chunk_locks_lock = threading.Lock()
+        self.deposits_lock = threading.Lock()
         np.random.seed(self.seed)
         import random
         random.seed(self.seed)
@@ -74,13 +104,25 @@ class Map:
         print(
             f"Generated {len(self.samples)} samples.\nFirst 5 points: {self.samples[:5]}")
 
+    def stage_rng(self, stage):
+        # Independent stream per stage, untouched by the global RNGs
+        return np.random.default_rng(np.random.SeedSequence([self.seed, stage]))
+
     @profile
     def assign_resources_to_samples(self):
-        sample_resources = []
-        for _ in range(len(self.samples)):
-            stage_resources = [np.random.choice(
-                list(resources.keys()), p=self.normalize_weights(stage)) for stage in range(4)]
-            sample_resources.append(stage_resources)
+        """
+        Draw every sample's resource ID for each of the 4 stages at once by
+        inverse-CDF sampling, giving an (n_samples, 4) array.
+        """
+        resource_ids = np.array([resources[resource]['id']
+                                 for resource in resources], dtype=LAYER_DTYPE)
+        sample_resources = np.empty((len(self.samples), 4), dtype=LAYER_DTYPE)
+        for stage in range(4):
+            cdf = np.cumsum(self.normalize_weights(stage))
+            draws = self.stage_rng(stage).random(len(self.samples))
+            # side='right' never picks a zero-weight resource
+            picks = np.searchsorted(cdf, draws, side='right')
+            sample_resources[:, stage] = resource_ids[np.minimum(picks, len(cdf) - 1)]
         self.sample_resources = sample_resources
 
     def normalize_weights(self, stage):
@@ -88,60 +130,88 @@ class Map:
                            for resource in resources])
         return weights / weights.sum()
 
-    def generate_perlin(self):
-        self.world_map = np.zeros((self.height, self.width))
-        for x in range(self.width):
-            for y in range(self.height):
-                self.world_map[x][y] = snoise2(x/self.frequency,
-                                               y/self.frequency,
-                                               octaves=self.octaves,
-                                               persistence=self.persistence,
-                                               lacunarity=self.lacunarity,
-                                               repeatx=5000,
-                                               repeaty=5000,
-                                               base=self.seed)
+    def noise_params(self):
+        # repeatx/repeaty are periods in noise space (pixels / frequency), so
+        # 5000 only tiles after 1,000,000 pixels and does not bound the world
+        return dict(frequency=self.frequency,
+                    octaves=self.octaves,
+                    persistence=self.persistence,
+                    lacunarity=self.lacunarity,
+                    repeatx=5000,
+                    repeaty=5000,
+                    base=self.seed)
+
+    def generate_perlin(self, workers=None, verify=False):
+        # Noise is evaluated a chunk at a time as whole arrays, optionally
+        # spread over `workers` processes
+        noise_params = self.noise_params()
+        self.world_map = generate_noise_field(self.height, self.width,
+                                              chunk_size=self.chunk_size,
+                                              workers=workers,
+                                              dtype=np.float32,
+                                              **noise_params)
+        if verify:
+            # Spot check the batched field against noise.snoise2
+            error = verify_noise_field(self.world_map, **noise_params)
+            print(f"Noise field matches snoise2 (max error {error}).")
 
     @profile
-    def generate_map(self):
+    def generate_map(self, workers=None, verify=False, engine='grid'):
         print("Generating Perlin noise map...")
-        self.generate_perlin()
+        self.generate_perlin(workers=workers, verify=verify)
         print("Generating Voronoi samples...")
         self.generate_samples()
-        # Generate a grid of coordinates
-        y, x = np.mgrid[0:self.height, 0:self.width]
 
-        # Compute the nearest sample point for the entire grid at once
+        if self.sample_resources is None:
+            self.assign_resources_to_samples()
+        stage_ids = self.sample_resources
+        self.save_sites(self.samples, stage_ids, pipeline='eager')
+
+        # Label the grid a band of rows at a time so only one band of
+        # coordinates and indices is ever held in memory. Both engines give
+        # the same labels, ties going to the lowest (x, y) sample
         print("Generating Voronoi map...")
-        tree = cKDTree(self.samples)
-        _, indices = tree.query(np.column_stack((y.ravel(), x.ravel())))
-        indices = indices.reshape(self.height, self.width)
+        voronoi_map = np.zeros((self.height, self.width, LAYERS), dtype=LAYER_DTYPE)
+        for row_start, row_end, indices in tqdm.tqdm(self.label_bands(engine, workers),
+                                                     total=-(-self.height // self.chunk_size), desc="Bands"):
+            # Resource IDs for every stage in one lookup table gather
+            voronoi_map[row_start:row_end, :, :4] = stage_ids[indices]
+            # Assign terrain types based on Perlin noise map
+            voronoi_map[row_start:row_end, :, 4] = self.classify_terrain(
+                self.world_map[row_start:row_end])
+
+        self.generate_chunks(voronoi_map)
+        return voronoi_map
 
-        # Assign terrain types based on Perlin noise map
-        print("Assigning terrain types...")
+    def label_bands(self, engine='grid', workers=None):
+        """
+        Yield (row_start, row_end, indices) of the nearest sample for every
+        pixel, a band of chunk_size rows at a time. The grid engine bins the
+        samples into cells of 2r, twice the Poisson spacing; the kdtree
+        engine is the reference it is checked against.
+        """
+        samples = np.asarray(self.samples)
+        if engine == 'grid':
+            yield from label_bands(samples, self.height, self.width, band_rows=self.chunk_size,
+                                   cell=2 * self.r, workers=workers)
+        elif engine == 'kdtree':
+            tree = cKDTree(samples)
+            for row_start in range(0, self.height, self.chunk_size):
+                row_end = min(row_start + self.chunk_size, self.height)
+                y, x = np.mgrid[row_start:row_end, 0:self.width]
+                indices = nearest_sites(samples, np.column_stack((x.ravel(), y.ravel())), self.height, tree)
+                yield row_start, row_end, indices.reshape(row_end - row_start, self.width)
+        else:
+            raise ValueError(f"Unknown labelling engine {engine}.")
+
+    def classify_terrain(self, noise_map):
         terrain_types = np.array([(attributes['id'], attributes['range'][0], attributes['range'][1])
                                   for terrain_type, attributes in overworld.items()],
                                  dtype=[('id', 'i4'), ('start', 'f4'), ('end', 'f4')])
         terrain_types.sort(order='start')  # Sort by start of range
         terrain_indices = np.searchsorted(
-            terrain_types['start'], self.world_map.ravel(), side='right') - 1
-        terrain_map = terrain_types['id'][terrain_indices].reshape(
-            self.world_map.shape)
-
-        if not self.sample_resources:
-            self.assign_resources_to_samples()
-
-        # Assign resource IDs
-        print("Assigning resource IDs...")
-        # 5 layers: 4 stages + 1 Perlin
-        voronoi_map = np.zeros((self.height, self.width, 5), dtype=int)
-        for stage in tqdm.tqdm(range(4), desc="Stages"):  # Correct usage is tqdm.tqdm()
-            voronoi_map[..., stage] = np.vectorize(
-                lambda idx: resources[self.sample_resources[idx][stage]]['id'])(indices)
-
-        # Add terrain map as the 5th layer in the Voronoi map
-        voronoi_map[..., 4] = terrain_map
-        self.generate_chunks(voronoi_map)
-        return voronoi_map
+            terrain_types['start'], noise_map.ravel(), side='right') - 1
+        return terrain_types['id'].astype(LAYER_DTYPE)[terrain_indices].reshape(noise_map.shape)
 
     @profile
     def get_terrain_type(self, value):
@@ -150,68 +220,412 @@ class Map:
                 return attributes['id']
         return 0  # Default to 'Water' if no other terrain type matches
 
+    def params(self):
+        # Everything that determines the generated world
+        return dict(height=self.height,
+                    width=self.width,
+                    chunk_size=self.chunk_size,
+                    r=self.r,
+                    frequency=self.frequency,
+                    octaves=self.octaves,
+                    persistence=self.persistence,
+                    lacunarity=self.lacunarity,
+                    seed=self.seed,
+                    sample_margin=self.sample_margin)
+
+    def level_shape(self, lod=0):
+        scale = 2 ** lod
+        return -(-self.height // scale), -(-self.width // scale)
+
+    def level_store_path(self, lod=0):
+        if lod == 0:
+            return self.store_path
+        root, ext = os.path.splitext(self.store_path)
+        return f'{root}.lod{lod}{ext}'
+
+    def open_store(self, mode='r', create=False, lod=0):
+        height, width = self.level_shape(lod)
+        return WorldStore.open(self.level_store_path(lod), height, width, self.chunk_size,
+                               LAYERS, LAYER_DTYPE, self.seed, mode=mode, create=create)
+
+    def get_store(self, lod=0):
+        # Opened on first use; lazy maps create the level 0 store and write
+        # into it
+        if lod not in self._stores:
+            lazy = self.lazy and lod == 0
+            self._stores[lod] = self.open_store(
+                mode='r+' if lazy else 'r', create=lazy, lod=lod)
+        return self._stores[lod]
+
+    def level_available(self, lod=0):
+        # Whether reads at lod can be served: lazy maps generate level 0
+        # as needed, every other level has to be fully built
+        if lod == 0 and self.lazy:
+            return True
+        try:
+            return bool(self.get_store(lod).chunk_table.all())
+        except ValueError:
+            return False
+
+    @property
+    def store(self):
+        return self.get_store(0)
+
+    def create_store(self, lod=0):
+        height, width = self.level_shape(lod)
+        self._stores[lod] = WorldStore.create(self.level_store_path(lod), height, width, self.chunk_size,
+                                              LAYERS, LAYER_DTYPE, self.seed)
+        return self._stores[lod]
+
+    def save_chunk(self, chunk_row, chunk_col, chunk, lod=0):
+        self.get_store(lod).write_chunk(chunk_row, chunk_col, chunk)
+
+    def load_chunk(self, chunk_row, chunk_col, lod=0):
+        chunk = self.chunk_cache.get((lod, chunk_row, chunk_col))
+        if chunk is not None:
+            return chunk
+
+        store = self.get_store(lod)
+        if not store.has_chunk(chunk_row, chunk_col):
+            # Only level 0 chunks are generated on demand. A coarse chunk
+            # would need every finer chunk under it, so levels above 0 come
+            # from build_pyramid alone
+            if not self.lazy or lod > 0:
+                raise ValueError(
+                    f"Chunk ({chunk_row}, {chunk_col}) at lod {lod} does not exist.")
+            with self.chunk_locks_lock:
+                lock = self.chunk_locks.setdefault((chunk_row, chunk_col), threading.Lock())
+            with lock:
+                # Another thread may have generated it while we waited
+                if not store.has_chunk(chunk_row, chunk_col):
+                    self.generate_chunk(chunk_row, chunk_col)
+            with self.chunk_locks_lock:
+                self.chunk_locks.pop((chunk_row, chunk_col), None)
+
+        # Copy out of the memory-mapped store so cached chunks stay resident
+        chunk = np.array(store.read_chunk(chunk_row, chunk_col))
+        chunk.setflags(write=False)
+        self.chunk_cache.put((lod, chunk_row, chunk_col), chunk)
+        return chunk
+
+    def cache_stats(self):
+        return self.chunk_cache.stats()
+
+    def chunk_seed(self, chunk_row, chunk_col):
+        # Independent, reproducible seed for the samples of each chunk
+        return int(np.random.SeedSequence([self.seed, chunk_row, chunk_col]).generate_state(1)[0]) + 1
+
+    def get_chunk_samples(self, chunk_row, chunk_col):
+        """
+        Poisson samples (x, y) and their per-stage resource IDs for one chunk,
+        seeded only by the world seed and the chunk position.
+        """
+        key = (chunk_row, chunk_col)
+        if key not in self.chunk_samples_cache:
+            row_start, col_start = chunk_row * self.chunk_size, chunk_col * self.chunk_size
+            rows = min(self.chunk_size, self.height - row_start)
+            cols = min(self.chunk_size, self.width - col_start)
+            seed = self.chunk_seed(chunk_row, chunk_col)
+            samples = poisson_disc_samples(
+                cols, rows, self.r, data_type='int', seed=seed) + [col_start, row_start]
+
+            rng = np.random.default_rng(seed)
+            resource_ids = np.array([resources[resource]['id']
+                                    for resource in resources], dtype=LAYER_DTYPE)
+            stage_ids = np.column_stack([rng.choice(resource_ids, size=len(samples), p=self.normalize_weights(stage))
+                                         for stage in range(4)])
+            self.chunk_samples_cache[key] = (samples, stage_ids)
+        return self.chunk_samples_cache[key]
+
+    def generate_chunk(self, chunk_row, chunk_col):
+        """
+        Generate and save a single chunk without building the rest of the world.
+        Samples from the neighbouring chunks within `sample_margin` are included
+        so Voronoi cells line up across chunk seams.
+        """
+        row_start, col_start = chunk_row * self.chunk_size, chunk_col * self.chunk_size
+        row_end = min(row_start + self.chunk_size, self.height)
+        col_end = min(col_start + self.chunk_size, self.width)
+
+        terrain_map = self.classify_terrain(
+            noise_chunk((row_start, row_end, col_start, col_end), **self.noise_params()))
+
+        # Gather samples from this chunk and the margin around it
+        samples, stage_ids = [], []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                n_row, n_col = chunk_row + d_row, chunk_col + d_col
+                if not (0 <= n_row * self.chunk_size < self.height and 0 <= n_col * self.chunk_size < self.width):
+                    continue
+                chunk_samples, chunk_ids = self.get_chunk_samples(n_row, n_col)
+                near = ((chunk_samples[:, 0] >= col_start - self.sample_margin) &
+                        (chunk_samples[:, 0] < col_end + self.sample_margin) &
+                        (chunk_samples[:, 1] >= row_start - self.sample_margin) &
+                        (chunk_samples[:, 1] < row_end + self.sample_margin))
+                samples.append(chunk_samples[near])
+                stage_ids.append(chunk_ids[near])
+        samples = np.concatenate(samples)
+        stage_ids = np.concatenate(stage_ids)
+
+        # Nearest sample for every point in the chunk. Integer samples are
+        # often equidistant, so ties go to the lowest (x, y) sample to keep
+        # the choice independent of which samples a chunk can see
+        y, x = np.mgrid[row_start:row_end, col_start:col_end]
+        indices = nearest_sites(samples, np.column_stack((x.ravel(), y.ravel())), self.height)
+
+        chunk = np.zeros((row_end - row_start, col_end - col_start, LAYERS), dtype=LAYER_DTYPE)
+        chunk[..., :4] = stage_ids[indices].reshape(chunk.shape[0], chunk.shape[1], 4)
+        chunk[..., 4] = terrain_map
+        self.save_chunk(chunk_row, chunk_col, chunk)
+        return chunk
+
+    def load_chunk_samples(self):
+        """
+        Fill the per-chunk sample cache from the saved sites, so chunks read
+        their neighbours' samples instead of sampling them again. Returns
+        False when no sites were saved for this world.
+        """
+        loaded = load_sites(self.sites_path(), self.params(), pipeline='chunks')
+        if loaded is None:
+            return False
+        sites, stage_ids = loaded
+        chunk_rows = -(-self.height // self.chunk_size)
+        chunk_cols = -(-self.width // self.chunk_size)
+        # Every site lies in the chunk that sampled it
+        chunks = (sites[:, 1] // self.chunk_size) * chunk_cols + sites[:, 0] // self.chunk_size
+        order = np.argsort(chunks, kind='stable')
+        sites, stage_ids = sites[order].astype(int), stage_ids[order]
+        bounds = np.searchsorted(chunks[order], np.arange(chunk_rows * chunk_cols + 1))
+        for chunk in range(chunk_rows * chunk_cols):
+            start, end = bounds[chunk], bounds[chunk + 1]
+            self.chunk_samples_cache[divmod(chunk, chunk_cols)] = (sites[start:end], stage_ids[start:end])
+        return True
+
+    def drop_chunk_samples(self, before_row):
+        # Forget cached samples of chunk rows a streaming build has left behind
+        for key in [key for key in self.chunk_samples_cache if key[0] < before_row]:
+            del self.chunk_samples_cache[key]
+
+    def generate_band(self, band_start, band_end):
+        """
+        Generate chunk rows [band_start, band_end), yielding (chunk_row,
+        chunk_col, chunk) for the caller to write. The band is labelled in
+        one pass with the samples of its own chunk rows plus those within
+        `sample_margin` above and below it, giving the same chunks as
+        generate_chunk.
+        """
+        chunk_cols = -(-self.width // self.chunk_size)
+        row_start = band_start * self.chunk_size
+        row_end = min(band_end * self.chunk_size, self.height)
+        top = max(0, row_start - self.sample_margin)
+        bottom = min(self.height, row_end + self.sample_margin)
+
+        samples, stage_ids = [], []
+        for chunk_row in range(max(0, band_start - 1), band_end + 1):
+            if chunk_row * self.chunk_size >= self.height:
+                continue
+            for chunk_col in range(chunk_cols):
+                chunk_samples, chunk_ids = self.get_chunk_samples(chunk_row, chunk_col)
+                near = (chunk_samples[:, 1] >= top) & (chunk_samples[:, 1] < bottom)
+                samples.append(chunk_samples[near])
+                stage_ids.append(chunk_ids[near])
+        samples = np.concatenate(samples)
+        stage_ids = np.concatenate(stage_ids)
+
+        # Sites are shifted into a grid over rows [top, bottom); the shift
+        # keeps their (x, y) order, so tie-breaks are unchanged
+        grid = SiteGrid(samples - [0, top], bottom - top, self.width)
+        labels = grid.label_rows(row_start - top, row_end - top)
+
+        for chunk_row in range(band_start, band_end):
+            chunk_top = chunk_row * self.chunk_size
+            chunk_bottom = min(chunk_top + self.chunk_size, self.height)
+            for chunk_col in range(chunk_cols):
+                col_start = chunk_col * self.chunk_size
+                col_end = min(col_start + self.chunk_size, self.width)
+                chunk = np.zeros((chunk_bottom - chunk_top, col_end - col_start, LAYERS), dtype=LAYER_DTYPE)
+                chunk[..., :4] = stage_ids[labels[chunk_top - row_start:chunk_bottom - row_start,
+                                                  col_start:col_end]]
+                chunk[..., 4] = self.classify_terrain(
+                    noise_chunk((chunk_top, chunk_bottom, col_start, col_end), **self.noise_params()))
+                yield chunk_row, chunk_col, chunk
+
+    def stream_world(self, band_chunks=1):
+        """
+        Build the world a band of chunk rows at a time, so peak memory
+        follows the band size rather than the world size. Resumable
+        through the same manifest as build_world.
+        """
+        return stream_world(self, band_chunks=band_chunks)
+
+    def build_world(self, workers=None):
+        """
+        Build every chunk with the per-chunk pipeline used in lazy mode,
+        resumable through a manifest next to the store.
+        """
+        return build_world(self, workers=workers)
+
+    def sites_path(self):
+        return f'{os.path.splitext(self.store_path)[0]}.sites.npz'
+
+    def collect_chunk_sites(self):
+        # Sample sites of the per-chunk pipeline, gathered chunk by chunk
+        chunk_rows = -(-self.height // self.chunk_size)
+        chunk_cols = -(-self.width // self.chunk_size)
+        sites, stage_ids = [], []
+        for chunk_row in tqdm.tqdm(range(chunk_rows), desc="Sites"):
+            for chunk_col in range(chunk_cols):
+                chunk_sites, chunk_ids = self.get_chunk_samples(chunk_row, chunk_col)
+                sites.append(chunk_sites)
+                stage_ids.append(chunk_ids)
+        return np.concatenate(sites), np.concatenate(stage_ids)
+
+    def save_sites(self, sites=None, stage_ids=None, pipeline='chunks'):
+        if sites is None:
+            sites, stage_ids = self.collect_chunk_sites()
+        save_sites(self.sites_path(), sites, stage_ids, self.params(), pipeline)
+        self._deposits = None
+
+    @property
+    def deposits(self):
+        # Loaded on first use from the sites saved when the world was built.
+        # They are never sampled here, that would mean every chunk of the world
+        if self._deposits is None:
+            with self.deposits_lock:
+                if self._deposits is None:
+                    loaded = load_sites(self.sites_path(), self.params())
+                    if loaded is None:
+                        raise ValueError(
+                            f"No deposit sites for this world at {self.sites_path()}.")
+                    self._deposits = DepositIndex(*loaded)
+        return self._deposits
+
+    def chunk_histogram(self, chunk_row, chunk_col):
+        """
+        Tiles of every resource in a chunk, as a (4 stages, resources) array
+        indexed by resource ID.
+        """
+        return chunk_histogram(self.load_chunk(chunk_row, chunk_col), len(resources))
+
+    def generate_level_chunk(self, chunk_row, chunk_col, lod):
+        """
+        Build one chunk of pyramid level lod by mode-downsampling the
+        matching block of level lod - 1.
+        """
+        size = self.chunk_size
+        block = self.read_window(chunk_row * size * 2, (chunk_row + 1) * size * 2,
+                                 chunk_col * size * 2, (chunk_col + 1) * size * 2, lod=lod - 1)
+        chunk = downsample_mode(block)
+        self.save_chunk(chunk_row, chunk_col, chunk, lod=lod)
+        return chunk
+
+    def build_pyramid(self):
+        # Every level is rebuilt from the one below it
+        for lod in range(1, self.max_lod + 1):
+            store = self.create_store(lod)
+            for chunk_row in tqdm.tqdm(range(store.chunk_rows), desc=f"LOD {lod}"):
+                for chunk_col in range(store.chunk_cols):
+                    self.generate_level_chunk(chunk_row, chunk_col, lod)
+        self.chunk_cache.clear()
+
     @profile
     def generate_chunks(self, voronoi_map):
-        if not os.path.exists('./proc_map/chunks'):
-            os.makedirs('./proc_map/chunks')
-
+        self.create_store()
+        self.chunk_cache.clear()
         for i in range(0, self.height, self.chunk_size):
             for j in range(0, self.width, self.chunk_size):
                 chunk = voronoi_map[i:i+self.chunk_size,
-                                    j:j+self.chunk_size, :].tolist()
-                with open(f'./proc_map/chunks/chunk_{i}_{j}.pkl', 'wb') as f:
-                    pickle.dump(chunk, f)
+                                    j:j+self.chunk_size, :]
+                self.save_chunk(i // self.chunk_size,
+                                j // self.chunk_size, chunk)
+        self.build_pyramid()
+
+    def clip_window(self, min_y, max_y, min_x, max_x, lod=0):
+        height, width = self.level_shape(lod)
+        min_x, min_y = max(0, min_x), max(0, min_y)
+        return min_y, max(min_y, min(height, max_y)), min_x, max(min_x, min(width, max_x))
+
+    def window_chunks(self, min_y, max_y, min_x, max_x):
+        # Chunk rows and columns overlapping a clipped window
+        if max_x == min_x or max_y == min_y:
+            return range(0), range(0)
+        size = self.chunk_size
+        return range(min_y // size, (max_y - 1) // size + 1), range(min_x // size, (max_x - 1) // size + 1)
+
+    def missing_chunks(self, min_y, max_y, min_x, max_x, lod=0):
+        """
+        (chunk_row, chunk_col) of every chunk that reading the window at lod
+        would have to generate first. Only lazy maps generate, and only at
+        level 0, so this is empty otherwise.
+        """
+        if not self.lazy or lod > 0:
+            return []
+        store = self.get_store(0)
+        row_chunks, col_chunks = self.window_chunks(*self.clip_window(min_y, max_y, min_x, max_x))
+        return [(chunk_row, chunk_col) for chunk_row in row_chunks for chunk_col in col_chunks
+                if not store.has_chunk(chunk_row, chunk_col)]
+
+    def read_window(self, min_y, max_y, min_x, max_x, layer=-1, lod=0):
+        """
+        Return rows [min_y, max_y) and columns [min_x, max_x) of pyramid level
+        lod, clipped to the level, as a (rows, cols, layers) array or
+        (rows, cols) for a single layer. The window is assembled from
+        whole-chunk slices; when it fits inside one chunk the result is a
+        read-only view of the cached chunk.
+        """
+        min_y, max_y, min_x, max_x = self.clip_window(min_y, max_y, min_x, max_x, lod)
+        row_chunks, col_chunks = self.window_chunks(min_y, max_y, min_x, max_x)
+        layers = slice(None) if layer == -1 else layer
+        size = self.chunk_size
+
+        if len(row_chunks) == 1 and len(col_chunks) == 1:
+            chunk_row, chunk_col = row_chunks[0], col_chunks[0]
+            chunk = self.load_chunk(chunk_row, chunk_col, lod=lod)
+            return chunk[min_y - chunk_row * size:max_y - chunk_row * size,
+                         min_x - chunk_col * size:max_x - chunk_col * size, layers]
+
+        shape = (max_y - min_y, max_x - min_x) + \
+            ((LAYERS,) if layer == -1 else ())
+        region = np.zeros(shape, dtype=LAYER_DTYPE)
+        for chunk_row in row_chunks:
+            for chunk_col in col_chunks:
+                chunk = self.load_chunk(chunk_row, chunk_col, lod=lod)
+                # Overlap of the window with this chunk, in level coordinates
+                top, bottom = max(min_y, chunk_row * size), min(max_y, (chunk_row + 1) * size)
+                left, right = max(min_x, chunk_col * size), min(max_x, (chunk_col + 1) * size)
+                region[top - min_y:bottom - min_y, left - min_x:right - min_x] = \
+                    chunk[top - chunk_row * size:bottom - chunk_row * size,
+                          left - chunk_col * size:right - chunk_col * size, layers]
+        return region
 
     @profile
-    def get_region(self, x, y, r=50, layer=-1):
-        min_x = max(0, x - r)
-        min_y = max(0, y - r)
-        max_x = min(self.width, x + r)
-        max_y = min(self.height, y + r)
-        region = [[[0]*5 for _ in range(max_x-min_x)]
-                  for _ in range(max_y-min_y)]
-
-        # Calculate chunk coordinates for all points in the region
-        chunk_coords = [(j // self.chunk_size, i // self.chunk_size)
-                        for j in range(min_x, max_x)
-                        for i in range(min_y, max_y)]
-        # Remove duplicates
-        chunk_coords = list(set(chunk_coords))
-
-        # Load all chunks into memory
-        chunks = {}
-        for chunk_x, chunk_y in chunk_coords:
-            with open(f'proc_map/chunks/chunk_{chunk_x*self.chunk_size}_{chunk_y*self.chunk_size}.pkl', 'rb') as f:
-                chunks[(chunk_x, chunk_y)] = pickle.load(f)
-
-        # Extract points from chunks
-        for i in range(min_x, max_x):
-            for j in range(min_y, max_y):
-                chunk_x, chunk_y = i // self.chunk_size, j // self.chunk_size
-                chunk = chunks[(chunk_x, chunk_y)]
-                value = chunk[(i % self.chunk_size)][(j % self.chunk_size)]
-
-                # If layer is -1, we return all layers, otherwise we return the specified layer
-                if layer != -1:
-                    value = value[layer] if len(value) > layer else None
-                region[j-min_y][i-min_x] = value
-        return region
+    def get_region(self, x, y, r=50, layer=-1, lod=0):
+        """
+        Return the window around (x, y) as a (rows=y, cols=x, layers) array,
+        or (rows, cols) for a single layer. At lod n the window is read from
+        the pyramid level downsampled 2**n times, so each cell covers
+        2**n x 2**n tiles and the result is about 2**n times smaller per side.
+        """
+        return self.read_window(*self.region_window(x, y, r, lod), layer=layer, lod=lod)
+
+    def region_window(self, x, y, r=50, lod=0):
+        # (min_y, max_y, min_x, max_x) of get_region's window in level lod
+        if not 0 <= lod <= self.max_lod:
+            raise ValueError(f"lod must be between 0 and {self.max_lod}.")
+        scale = 2 ** lod
+        x, y, r = x // scale, y // scale, max(1, r // scale)
+        return y - r, y + r, x - r, x + r
 
     def get_layers_at_point(self, x, y):
-        chunk_x = x // self.chunk_size
-        chunk_y = y // self.chunk_size
-        point_x = x % self.chunk_size
+        chunk_row = y // self.chunk_size
+        chunk_col = x // self.chunk_size
         point_y = y % self.chunk_size
+        point_x = x % self.chunk_size
 
-        chunk_filename = f'./proc_map/chunks/chunk_{chunk_x*self.chunk_size}_{chunk_y*self.chunk_size}.pkl'
-        if not os.path.exists(chunk_filename):
-            raise ValueError(f"Chunk at ({x}, {y}) does not exist.")
-
-        with open(chunk_filename, 'rb') as f:
-            chunk = pickle.load(f)
+        chunk = self.load_chunk(chunk_row, chunk_col)
 
-        layers = chunk[point_y][point_x]
-        return layers
+        layers = chunk[point_y, point_x]
+        return layers.tolist()
 
     def plot_map(self, map_layer):
         plt.figure(figsize=(10, 10))  # adjust size as needed
@@ -0,0 +1,287 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# NumPy port of the simplex noise used by `noise.snoise2`. All arithmetic is
+# done in float32 so the batched field lines up with the C extension.
+
+F2 = np.float32(0.3660254037844386)  # 0.5 * (sqrt(3.0) - 1.0)
+G2 = np.float32(0.21132486540518713)  # (3.0 - sqrt(3.0)) / 6.0
+F4 = np.float32(0.30901699437494745)  # (sqrt(5.0) - 1.0) / 4.0
+G4 = np.float32(0.1381966011250105)  # (5.0 - sqrt(5.0)) / 20.0
+
+GRAD3 = np.array([
+    [1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0],
+    [1, 0, 1], [-1, 0, 1], [1, 0, -1], [-1, 0, -1],
+    [0, 1, 1], [0, -1, 1], [0, 1, -1], [0, -1, -1],
+    [1, 0, -1], [-1, 0, -1], [0, -1, 1], [0, 1, 1]], dtype=np.float32)
+
+GRAD4 = np.array([
+    [0, 1, 1, 1], [0, 1, 1, -1], [0, 1, -1, 1], [0, 1, -1, -1],
+    [0, -1, 1, 1], [0, -1, 1, -1], [0, -1, -1, 1], [0, -1, -1, -1],
+    [1, 0, 1, 1], [1, 0, 1, -1], [1, 0, -1, 1], [1, 0, -1, -1],
+    [-1, 0, 1, 1], [-1, 0, 1, -1], [-1, 0, -1, 1], [-1, 0, -1, -1],
+    [1, 1, 0, 1], [1, 1, 0, -1], [1, -1, 0, 1], [1, -1, 0, -1],
+    [-1, 1, 0, 1], [-1, 1, 0, -1], [-1, -1, 0, 1], [-1, -1, 0, -1],
+    [1, 1, 1, 0], [1, 1, -1, 0], [1, -1, 1, 0], [1, -1, -1, 0],
+    [-1, 1, 1, 0], [-1, 1, -1, 0], [-1, -1, 1, 0], [-1, -1, -1, 0]], dtype=np.float32)
+
+_PERM_BASE = [
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225, 140,
+    36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247, 120,
+    234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57, 177, 33,
+    88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74, 165, 71,
+    134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122, 60, 211, 133,
+    230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54, 65, 25, 63, 161,
+    1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200, 196, 135, 130,
+    116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64, 52, 217, 226, 250,
+    124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212, 207, 206, 59, 227,
+    47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213, 119, 248, 152, 2, 44,
+    154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22, 39, 253, 19, 98,
+    108, 110, 79, 113, 224, 232, 178, 185, 112, 104, 218, 246, 97, 228, 251, 34,
+    242, 193, 238, 210, 144, 12, 191, 179, 162, 241, 81, 51, 145, 235, 249, 14,
+    239, 107, 49, 192, 214, 31, 181, 199, 106, 157, 184, 84, 204, 176, 115, 121,
+    50, 45, 127, 4, 150, 254, 138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243,
+    141, 128, 195, 78, 66, 215, 61, 156, 180]
+PERM = np.array(_PERM_BASE * 2, dtype=np.int64)
+
+SIMPLEX = np.array([
+    [0, 1, 2, 3], [0, 1, 3, 2], [0, 0, 0, 0], [0, 2, 3, 1], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0],
+    [1, 2, 3, 0], [0, 2, 1, 3], [0, 0, 0, 0], [0, 3, 1, 2], [0, 3, 2, 1], [0, 0, 0, 0], [0, 0, 0, 0],
+    [0, 0, 0, 0], [1, 3, 2, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0],
+    [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [1, 2, 0, 3], [0, 0, 0, 0], [1, 3, 0, 2], [0, 0, 0, 0],
+    [0, 0, 0, 0], [0, 0, 0, 0], [2, 3, 0, 1], [2, 3, 1, 0], [1, 0, 2, 3], [1, 0, 3, 2], [0, 0, 0, 0],
+    [0, 0, 0, 0], [0, 0, 0, 0], [2, 0, 3, 1], [0, 0, 0, 0], [2, 1, 3, 0], [0, 0, 0, 0], [0, 0, 0, 0],
+    [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [2, 0, 1, 3],
+    [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [3, 0, 1, 2], [3, 0, 2, 1], [0, 0, 0, 0], [3, 1, 2, 0],
+    [2, 1, 0, 3], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [3, 1, 0, 2], [0, 0, 0, 0], [3, 2, 0, 1],
+    [3, 2, 1, 0]], dtype=np.int64)
+
+
+def _fast_sin(x):
+    """
+    Port of the extension's fast_sin, where x = [0, 2] covers a full turn.
+    """
+    z = x + np.float32(25165824.0)
+    x = x - (z - np.float32(25165824.0))
+    y = x - x * np.abs(x)
+    return y * (np.float32(3.1) + np.float32(3.6) * np.abs(y))
+
+
+def _fast_cos(x):
+    return _fast_sin(x + np.float32(0.5))
+
+
+def _noise2(x, y):
+    """
+    Single octave 2D simplex noise for float32 arrays of coordinates.
+    """
+    s = (x + y) * F2
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    t = (i + j) * G2
+
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+
+    i1 = (x0 > y0).astype(np.float32)
+    j1 = np.float32(1) - i1
+
+    I = i.astype(np.int64) & 255
+    J = j.astype(np.int64) & 255
+    I1 = i1.astype(np.int64)
+    J1 = j1.astype(np.int64)
+
+    corners = [
+        (x0, y0, PERM[I + PERM[J]] % 12),
+        (x0 - i1 + G2, y0 - j1 + G2, PERM[I + I1 + PERM[J + J1]] % 12),
+        (x0 + G2 * np.float32(2) - np.float32(1), y0 + G2 * np.float32(2) - np.float32(1),
+         PERM[I + 1 + PERM[J + 1]] % 12),
+    ]
+
+    total = np.zeros_like(x)
+    for xc, yc, g in corners:
+        f = np.float32(0.5) - xc * xc - yc * yc
+        grad = GRAD3[g]
+        n = f * f * f * f * (grad[:, 0] * xc + grad[:, 1] * yc)
+        total += np.where(f > 0, n, np.float32(0))
+    return total * np.float32(70)
+
+
+def _noise4(x, y, z, w):
+    """
+    Single octave 4D simplex noise for float32 arrays of coordinates.
+    """
+    s = (x + y + z + w) * F4
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    k = np.floor(z + s)
+    l = np.floor(w + s)
+    t = (i + j + k + l) * G4
+
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    w0 = w - (l - t)
+
+    # Rank the coordinates to find which simplex we are in
+    c = ((x0 > y0) * 32 + (x0 > z0) * 16 + (y0 > z0) * 8 +
+         (x0 > w0) * 4 + (y0 > w0) * 2 + (z0 > w0))
+    simplex = SIMPLEX[c]
+
+    I = i.astype(np.int64) & 255
+    J = j.astype(np.int64) & 255
+    K = k.astype(np.int64) & 255
+    L = l.astype(np.int64) & 255
+
+    total = np.zeros_like(x)
+    for corner in range(5):
+        if corner == 0:
+            offset = np.zeros((len(x), 4), dtype=np.int64)
+        elif corner == 4:
+            offset = np.ones((len(x), 4), dtype=np.int64)
+        else:
+            offset = (simplex >= 4 - corner).astype(np.int64)
+        shift = np.float32(corner) * G4
+        xc = x0 - offset[:, 0].astype(np.float32) + shift
+        yc = y0 - offset[:, 1].astype(np.float32) + shift
+        zc = z0 - offset[:, 2].astype(np.float32) + shift
+        wc = w0 - offset[:, 3].astype(np.float32) + shift
+
+        gi = PERM[I + offset[:, 0] + PERM[J + offset[:, 1] +
+                  PERM[K + offset[:, 2] + PERM[L + offset[:, 3]]]]] & 0x1f
+        grad = GRAD4[gi]
+
+        f = np.float32(0.6) - xc * xc - yc * yc - zc * zc - wc * wc
+        f2 = f * f
+        n = f2 * f2 * (grad[:, 0] * xc + grad[:, 1] * yc +
+                       grad[:, 2] * zc + grad[:, 3] * wc)
+        total += np.where(f >= 0, n, np.float32(0))
+    return (27.0 * total.astype(np.float64)).astype(np.float32)
+
+
+def snoise2_array(x, y, octaves=1, persistence=0.5, lacunarity=2.0, repeatx=None, repeaty=None, base=0.0):
+    """
+    Vectorized equivalent of noise.snoise2 for arrays of coordinates.
+    """
+    if octaves <= 0:
+        raise ValueError("Expected octaves value > 0")
+    if (repeatx is None) != (repeaty is None):
+        raise ValueError("repeatx and repeaty must be given together")
+
+    shape = np.shape(x)
+    x = np.asarray(x, dtype=np.float32).ravel()
+    y = np.asarray(y, dtype=np.float32).ravel()
+    persistence = np.float32(persistence)
+    lacunarity = np.float32(lacunarity)
+    z = np.float32(base)
+
+    if repeatx is None:
+        # Flat noise, no tiling
+        noise_fn = _noise2
+
+        def octave_coords(freq):
+            return (x * freq + z, y * freq + z)
+    else:
+        # Tiled noise wraps each axis around a circle in 4D space
+        yf = (y.astype(np.float64) * 2.0 / np.float32(repeaty)).astype(np.float32)
+        yr = np.float32(float(np.float32(repeaty)) * (1 / np.pi) * 0.5)
+        tw = z + _fast_cos(yf) * yr
+        ty = _fast_sin(yf) * yr
+
+        xf = (x.astype(np.float64) * 2.0 / np.float32(repeatx)).astype(np.float32)
+        xr = np.float32(float(np.float32(repeatx)) * (1 / np.pi) * 0.5)
+        tz = z + _fast_cos(xf) * xr
+        tx = _fast_sin(xf) * xr
+        noise_fn = _noise4
+
+        def octave_coords(freq):
+            return (tx * freq, ty * freq, tz * freq, tw * freq)
+
+    freq = np.float32(1)
+    amp = np.float32(1)
+    max_amp = np.float32(1)
+    total = noise_fn(*octave_coords(freq))
+    for _ in range(1, octaves):
+        freq *= lacunarity
+        amp *= persistence
+        max_amp += amp
+        total += noise_fn(*octave_coords(freq)) * amp
+    return (total / max_amp).astype(np.float64).reshape(shape)
+
+
+def noise_chunk(bounds, frequency, octaves, persistence, lacunarity, repeatx, repeaty, base):
+    """
+    Evaluate the noise for one [row_start:row_end, col_start:col_end] block.
+    Rows map to the y coordinate and columns to x.
+    """
+    row_start, row_end, col_start, col_end = bounds
+    rows, cols = np.mgrid[row_start:row_end, col_start:col_end]
+    # Coordinates are divided in double precision like the original loop
+    return snoise2_array(cols / frequency, rows / frequency,
+                         octaves=octaves,
+                         persistence=persistence,
+                         lacunarity=lacunarity,
+                         repeatx=repeatx,
+                         repeaty=repeaty,
+                         base=base)
+
+
+def _chunk_bounds(height, width, chunk_size):
+    return [(i, min(i + chunk_size, height), j, min(j + chunk_size, width))
+            for i in range(0, height, chunk_size)
+            for j in range(0, width, chunk_size)]
+
+
+def generate_noise_field(height, width, chunk_size=500, frequency=200, octaves=6, persistence=0.5,
+                         lacunarity=2, repeatx=None, repeaty=None, base=0, workers=None, dtype=np.float64):
+    """
+    Build a full noise field chunk by chunk, optionally fanning the chunks
+    out over a process pool when workers > 1.
+    """
+    field = np.zeros((height, width), dtype=dtype)
+    bounds = _chunk_bounds(height, width, chunk_size)
+    params = (frequency, octaves, persistence, lacunarity, repeatx, repeaty, base)
+
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(noise_chunk, b, *params) for b in bounds]
+            for (i0, i1, j0, j1), future in zip(bounds, futures):
+                field[i0:i1, j0:j1] = future.result()
+    else:
+        for i0, i1, j0, j1 in bounds:
+            field[i0:i1, j0:j1] = noise_chunk((i0, i1, j0, j1), *params)
+    return field
+
+
+def verify_noise_field(field, frequency=200, octaves=6, persistence=0.5, lacunarity=2, repeatx=None,
+                       repeaty=None, base=0, samples=10000, tolerance=1e-4, seed=0):
+    """
+    Check a batched field against noise.snoise2 at random points (or every
+    point when samples is None). Returns the largest absolute difference and
+    raises ValueError if it is above the tolerance.
+    """
+    from noise import snoise2
+
+    height, width = field.shape
+    if samples is None:
+        rows, cols = np.mgrid[0:height, 0:width]
+        rows, cols = rows.ravel(), cols.ravel()
+    else:
+        rng = np.random.default_rng(seed)
+        rows = rng.integers(0, height, samples)
+        cols = rng.integers(0, width, samples)
+
+    kwargs = dict(octaves=octaves, persistence=persistence,
+                  lacunarity=lacunarity, base=base)
+    if repeatx is not None:
+        kwargs.update(repeatx=repeatx, repeaty=repeaty)
+
+    max_error = 0.0
+    for y, x in zip(rows, cols):
+        expected = snoise2(x / frequency, y / frequency, **kwargs)
+        max_error = max(max_error, abs(expected - field[y, x]))
+
+    if max_error > tolerance:
+        raise ValueError(
+            f"Noise field differs from snoise2 by {max_error} (tolerance {tolerance})")
+    return max_error
@@ -1,101 +1,90 @@
+import math
 import numpy as np
-from collections import deque
 import random
 # from test import profile, write_profiles_to_file
 
 
-def euclidean_distance(p1, p2):
-    """
-    Compute the Euclidean distance between two points.
-    """
-    return np.sqrt(np.sum((p1 - p2) ** 2))
-
-
 # @profile
 def poisson_disc_samples(width, height, r, seed=None, k=5, data_type='float'):
     """
     Generate Poisson disc samples using a more efficient algorithm.
+    Candidates are checked one at a time in plain Python against a flat
+    list of sample indices; with k = 5 there are too few per point to
+    pay for NumPy's per-call overhead.
     """
     # If no seed is provided, generate a random seed
     seed = seed or random.randint(0, 1000000)
-    random.seed(seed)  # Seed the random number generator
+    # A generator of our own, so chunks sampled on different threads don't
+    # share (and reorder) the global random state
+    rng = random.Random(seed)
     print("Seed: {}".format(seed))
 
-    tau = 2 * np.pi  # Constant for 2*pi
-    cell_size = r / np.sqrt(2)  # The size of each cell in the grid
+    tau = 2 * math.pi  # Constant for 2*pi
+    cell_size = r / math.sqrt(2)  # The size of each cell in the grid
 
     # The number of cells along the width and height
-    grid_width = int(np.ceil(width / cell_size))
-    grid_height = int(np.ceil(height / cell_size))
-
-    # Initialize the grid with None
-    grid = [[None for _ in range(grid_height)] for _ in range(grid_width)]
-
-    # Function to convert continuous coordinates to discrete grid coordinates
-    def grid_coords(p):
-        return int(p[0] // cell_size), int(p[1] // cell_size)
+    grid_width = int(math.ceil(width / cell_size))
+    grid_height = int(math.ceil(height / cell_size))
+
+    # Each grid cell holds the index of its sample, or -1. The grid is
+    # flattened column by column and padded by one cell on every side so
+    # neighbourhood lookups never fall off the edge
+    stride = grid_height + 2
+    grid = [-1] * ((grid_width + 2) * stride)
+    neighbours = [dx * stride + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    xs, ys = [], []
+
+    def add(x, y):
+        grid[(int(x // cell_size) + 1) * stride + int(y // cell_size) + 1] = len(xs)
+        xs.append(x)
+        ys.append(y)
 
     # Generate a random initial point
-    p = np.array([width * random.random(), height * random.random()])
+    add(width * rng.random(), height * rng.random())
 
-    # The active list is implemented as a deque for efficient pops from the end
-    active_list = deque([p])
-
-    # The initial point is added to the grid
-    gx, gy = grid_coords(p)
-    grid[gx][gy] = p
-
-    # The result list of points starts with the initial point
-    points = [p]
+    # The active list holds sample indices
+    active_list = [0]
 
     # While there are still points in the active list
     while active_list:
         # Randomly select a point from the active list
-        idx = random.randint(0, len(active_list) - 1)
+        idx = rng.randint(0, len(active_list) - 1)
         # Swap the selected point with the one at the end of the active list
         active_list[idx], active_list[-1] = active_list[-1], active_list[idx]
         # Pop the selected point from the active list
-        p = active_list.pop()
+        i = active_list.pop()
+        px, py = xs[i], ys[i]
 
         # For each new candidate point around the selected point
         for _ in range(k):
             # Generate a random point within the annulus around the selected point
-            alpha = tau * random.random()
-            d = r * np.sqrt(3 * random.random() + 1)
-            q = p + d * np.array([np.cos(alpha), np.sin(alpha)])
+            alpha = tau * rng.random()
+            d = r * math.sqrt(3 * rng.random() + 1)
+            qx, qy = px + d * math.cos(alpha), py + d * math.sin(alpha)
 
             # If the new point is outside the area, skip it
-            if not (0 <= q[0] < width and 0 <= q[1] < height):
+            if not (0 <= qx < width and 0 <= qy < height):
                 continue
 
-            # Get the grid cell of the new point
-            gx, gy = grid_coords(q)
-
-            # Check if the new point is too close to other points
-            too_close = False
-
-            # Iterate over the 3x3 grid cell neighborhood of the new point
-            for x in range(max(gx - 1, 0), min(gx + 2, grid_width)):
-                for y in range(max(gy - 1, 0), min(gy + 2, grid_height)):
-                    # If the grid cell is not empty and the point in the cell is too close to the new point
-                    if grid[x][y] is not None and euclidean_distance(q, grid[x][y]) < r:
-                        too_close = True
-                        break
-                if too_close:
+            # Reject the new point if it is too close to a sample in the
+            # 3x3 grid cell neighbourhood
+            cell = (int(qx // cell_size) + 1) * stride + int(qy // cell_size) + 1
+            for offset in neighbours:
+                j = grid[cell + offset]
+                if j >= 0 and math.sqrt((qx - xs[j]) ** 2 + (qy - ys[j]) ** 2) < r:
                     break
-            if too_close:
-                continue
+            else:
+                # Add the new point to the active list and the grid
+                active_list.append(len(xs))
+                add(qx, qy)
 
-            # If the new point is not too close to other points, add it to the active list and the grid
-            active_list.append(q)
-            grid[gx][gy] = q
-            points.append(q)
+    points = np.column_stack((xs, ys))
 
     # If the desired data type is 'int', convert the points to integers
     if data_type == 'int':
-        return np.array(points).astype(int)
+        return points.astype(int)
     else:
-        return points
+        return list(points)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def downsample_mode(block):
+    """
+    Halve a (rows, cols, layers) block by taking the most common value of
+    every 2x2 cell, per layer. Ties go to the smallest value. Odd edges are
+    padded by repeating the last row/column.
+    """
+    rows, cols = block.shape[:2]
+    pad_rows, pad_cols = rows % 2, cols % 2
+    if pad_rows or pad_cols:
+        block = np.pad(block, ((0, pad_rows), (0, pad_cols), (0, 0)), mode='edge')
+
+    # (rows/2, cols/2, layers, 4) candidates for every output cell
+    out_rows, out_cols, layers = block.shape[0] // 2, block.shape[1] // 2, block.shape[2]
+    cells = block.reshape(out_rows, 2, out_cols, 2, layers)
+    cells = cells.transpose(0, 2, 4, 1, 3).reshape(out_rows, out_cols, layers, 4)
+
+    counts = (cells[..., :, None] == cells[..., None, :]).sum(axis=-1)
+    # Highest count first, then the smallest value among equal counts
+    score = counts.astype(np.int32) * 256 - cells
+    winner = score.argmax(axis=-1)
+    return np.take_along_axis(cells, winner[..., None], axis=-1)[..., 0]
@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Labels every pixel with the index of its nearest sample site. Ties between
+# equidistant sites go to the lowest (x, y) site, so the result does not
+# depend on the search structure or on which sites a chunk can see.
+
+# Sites of the current worker process, set up once by _init_worker
+_worker_sites = None
+
+
+def site_keys(sites, height):
+    # Orders sites by x, then y, for tie-breaks
+    return sites[:, 0].astype(np.int64) * height + sites[:, 1]
+
+
+def nearest_sites(sites, points, height, tree=None):
+    """
+    Index of the nearest site for every (x, y) point, ties to the lowest
+    (x, y) site. KD-tree reference used by the per-chunk pipeline.
+    """
+    tree = tree or cKDTree(sites)
+    k = min(4, len(sites))
+    distances, neighbours = tree.query(points, k=k)
+    distances, neighbours = distances.reshape(len(points), k), neighbours.reshape(len(points), k)
+    keys = site_keys(sites, height)[np.minimum(neighbours, len(sites) - 1)]
+    keys = np.where(distances == distances[:, :1], keys, np.iinfo(np.int64).max)
+    return neighbours[np.arange(len(neighbours)), keys.argmin(axis=1)]
+
+
+class SiteGrid:
+    """
+    Sites binned into square cells of `cell` pixels. Every pixel is
+    resolved against the sites of the (2 * margin + 1)^2 cells around its
+    own; Poisson spacing keeps the nearest site well inside that window, and
+    the rare pixel whose nearest site could lie outside it falls back to a
+    KD-tree.
+    """
+
+    def __init__(self, sites, height, width, cell=16, margin=1):
+        self.sites = np.asarray(sites, dtype=np.int64)
+        self.height, self.width = height, width
+        self.cell, self.margin = cell, margin
+        self.keys = site_keys(self.sites, height)
+        self.tree = None
+
+        grid_height, grid_width = -(-height // cell), -(-width // cell)
+        cells = (self.sites[:, 1] // cell) * grid_width + self.sites[:, 0] // cell
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=grid_height * grid_width)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        slot = np.arange(len(cells)) - starts[cells[order]]
+
+        # (rows, cols, slots) site indices, padded by `margin` empty cells on
+        # every side. Empty slots point at a sentinel site far off the map
+        depth = max(1, counts.max(initial=0))
+        self.cells = np.full((grid_height + 2 * margin, grid_width + 2 * margin, depth),
+                             len(self.sites), dtype=np.int64)
+        self.cells[cells[order] // grid_width + margin,
+                   cells[order] % grid_width + margin, slot] = order
+        # Distances are float32, exact for the squared pixel distances
+        # inside a window; the sentinel only has to lose every comparison
+        far = 4 * max(height, width)
+        self.site_x = np.append(self.sites[:, 0], far).astype(np.float32)
+        self.site_y = np.append(self.sites[:, 1], far).astype(np.float32)
+        self.sorted_keys = np.append(self.keys, np.iinfo(np.int64).max)
+
+    def label_rows(self, row_start, row_end, cell_batch=64):
+        """
+        Nearest site index of every pixel in rows [row_start, row_end), as
+        a (rows, width) int32 array.
+        """
+        cell, margin = self.cell, self.margin
+        window = 2 * margin + 1
+        labels = np.empty((row_end - row_start, self.width), dtype=np.int32)
+        grid_width = self.cells.shape[1] - 2 * margin
+
+        for cell_row in range(row_start // cell, (row_end - 1) // cell + 1):
+            top, bottom = max(row_start, cell_row * cell), min(row_end, (cell_row + 1) * cell)
+            # Every cell column's candidate sites, (grid_width, window^2 * depth)
+            block = np.lib.stride_tricks.sliding_window_view(
+                self.cells[cell_row:cell_row + window], window, axis=1)
+            candidates = block.transpose(1, 0, 3, 2).reshape(grid_width, -1)
+            # Candidates in key order, so the first of several equidistant
+            # sites is the tie-break winner, with the sentinel padding last
+            order = np.argsort(self.sorted_keys[candidates], axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            real = max(1, (candidates < len(self.sites)).sum(axis=1).max())
+            candidates = candidates[:, :real]
+
+            py, px = np.mgrid[top:bottom, 0:cell]
+            py, px = py.ravel(), px.ravel()
+            for first in range(0, grid_width, cell_batch):
+                cols = np.arange(first, min(first + cell_batch, grid_width))
+                # Pixels of each cell, (cells, pixels)
+                xs = cols[:, None] * cell + px
+                ys = np.broadcast_to(py, xs.shape)
+                cand = candidates[cols]
+                dx = xs[:, :, None].astype(np.float32) - self.site_x[cand][:, None, :]
+                dy = ys[:, :, None].astype(np.float32) - self.site_y[cand][:, None, :]
+                d2 = dx * dx + dy * dy
+                slot = d2.argmin(axis=2)
+                best = np.take_along_axis(d2, slot[:, :, None], axis=2)[:, :, 0]
+                nearest = np.take_along_axis(cand, slot, axis=1)
+
+                # Any site outside the window is at least `safe` away
+                safe = np.minimum.reduce([xs - (cols[:, None] - margin) * cell + 1,
+                                          (cols[:, None] + margin + 1) * cell - xs,
+                                          ys - (cell_row - margin) * cell + 1,
+                                          np.broadcast_to((cell_row + margin + 1) * cell - py, xs.shape)])
+                unsure = best >= safe * safe
+                if unsure.any():
+                    if self.tree is None:
+                        self.tree = cKDTree(self.sites)
+                    points = np.column_stack((xs[unsure], ys[unsure]))
+                    nearest[unsure] = nearest_sites(self.sites, points, self.height, self.tree)
+
+                inside = xs < self.width
+                labels[ys[inside] - row_start, xs[inside]] = nearest[inside]
+        return labels
+
+
+def _init_worker(sites, height, width, cell):
+    global _worker_sites
+    _worker_sites = SiteGrid(sites, height, width, cell=cell)
+
+
+def _label_band(row_start, row_end):
+    return _worker_sites.label_rows(row_start, row_end)
+
+
+def label_bands(sites, height, width, band_rows=500, cell=16, workers=None):
+    """
+    Yield (row_start, row_end, labels) for consecutive bands of rows, with
+    labels holding each pixel's nearest site index. Bands are labelled on
+    a process pool when workers > 1, and yielded in order.
+    """
+    bands = [(row_start, min(row_start + band_rows, height))
+             for row_start in range(0, height, band_rows)]
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(sites, height, width, cell)) as executor:
+            futures = [executor.submit(_label_band, *band) for band in bands]
+            for band, future in zip(bands, futures):
+                yield (*band, future.result())
+    else:
+        grid = SiteGrid(sites, height, width, cell=cell)
+        for band in bands:
+            yield (*band, grid.label_rows(*band))
@@ -0,0 +1,175 @@
+import json
+import os
+import pickle
+import re
+import tempfile
+import uuid
+import numpy as np
+
+MAGIC = b'VFWORLD1'
+# Version 2 stores chunks as (rows=y, cols=x, layers)
+FORMAT_VERSION = 2
+HEADER_SIZE = 4096
+PAGE_SIZE = 4096
+
+
+class WorldStore:
+    """
+    Binary world file read through np.memmap.
+
+    Layout:
+      header      HEADER_SIZE bytes, MAGIC followed by a JSON description
+                  (version, height, width, chunk_size, layers, dtype, seed)
+                  and a build ID, new every time the store is created
+      chunk table one uint8 per chunk, set once that chunk has been written
+      chunk data  fixed-stride (chunk_size, chunk_size, layers) blocks in
+                  row-major chunk order, edge chunks padded to the full stride
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if not header.startswith(MAGIC):
+            raise ValueError(f"{path} is not a world store.")
+        self.header = json.loads(header[len(MAGIC):].rstrip(b'\0'))
+
+        self.height = self.header['height']
+        self.width = self.header['width']
+        self.chunk_size = self.header['chunk_size']
+        self.layers = self.header['layers']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.seed = self.header['seed']
+        self.chunk_rows, self.chunk_cols = chunk_grid(
+            self.height, self.width, self.chunk_size)
+
+        self.chunk_table = np.memmap(path, dtype=np.uint8, mode=mode, offset=HEADER_SIZE,
+                                     shape=(self.chunk_rows, self.chunk_cols))
+        self.data = np.memmap(path, dtype=self.dtype, mode=mode,
+                              offset=data_offset(
+                                  self.chunk_rows, self.chunk_cols),
+                              shape=(self.chunk_rows, self.chunk_cols,
+                                     self.chunk_size, self.chunk_size, self.layers))
+
+    @classmethod
+    def create(cls, path, height, width, chunk_size, layers, dtype, seed, replace=True):
+        """
+        Write an empty store to path. With replace=True any existing store
+        is replaced; otherwise an existing one, for instance created by
+        another process meanwhile, is kept and opened instead.
+        """
+        header = {'version': FORMAT_VERSION, 'height': height, 'width': width, 'chunk_size': chunk_size,
+                  'layers': layers, 'dtype': np.dtype(dtype).name, 'seed': seed, 'build': uuid.uuid4().hex}
+        encoded = MAGIC + json.dumps(header).encode()
+        if len(encoded) > HEADER_SIZE:
+            raise ValueError("World store header is too large.")
+
+        chunk_rows, chunk_cols = chunk_grid(height, width, chunk_size)
+        size = data_offset(chunk_rows, chunk_cols) + chunk_rows * chunk_cols * \
+            chunk_size * chunk_size * layers * np.dtype(dtype).itemsize
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # The store is written under a name unique to this call and then
+        # published whole. A new file replaces any old one, so a process that
+        # still has the old store mapped keeps reading the old build
+        fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded.ljust(HEADER_SIZE, b'\0'))
+                # Chunks that are never written stay as holes in a sparse file
+                f.truncate(size)
+            os.chmod(tmp_path, 0o644)
+            if replace:
+                os.replace(tmp_path, path)
+            else:
+                try:
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    pass  # Created by someone else first, theirs is used
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return cls(path, mode='r+')
+
+    @classmethod
+    def open(cls, path, height, width, chunk_size, layers, dtype, seed, mode='r', create=False):
+        """
+        Open the store at path, checking it was built with the given
+        parameters. With create=True a missing store is created empty.
+        """
+        if not os.path.exists(path):
+            if not create:
+                raise ValueError(f"World store {path} does not exist.")
+            # Another process may create it at the same time, so the store
+            # that wins is checked like any existing one
+            cls.create(path, height, width, chunk_size, layers, dtype, seed, replace=False)
+
+        store = cls(path, mode=mode)
+        expected = {'version': FORMAT_VERSION, 'height': height, 'width': width, 'chunk_size': chunk_size,
+                    'layers': layers, 'dtype': np.dtype(dtype).name, 'seed': seed}
+        # The build ID identifies the contents, not the parameters
+        if {key: value for key, value in store.header.items() if key != 'build'} != expected:
+            raise ValueError(
+                f"World store {path} was built with {store.header}, expected {expected}.")
+        return store
+
+    @property
+    def build_id(self):
+        # Stores written before build IDs fall back to their creation header
+        return self.header.get('build') or json.dumps(self.header, sort_keys=True)
+
+    def chunk_shape(self, chunk_row, chunk_col):
+        rows = min(self.chunk_size, self.height - chunk_row * self.chunk_size)
+        cols = min(self.chunk_size, self.width - chunk_col * self.chunk_size)
+        return rows, cols
+
+    def has_chunk(self, chunk_row, chunk_col):
+        return bool(self.chunk_table[chunk_row, chunk_col])
+
+    def read_chunk(self, chunk_row, chunk_col):
+        # A view into the mapped file, trimmed to the chunk's real extent
+        rows, cols = self.chunk_shape(chunk_row, chunk_col)
+        return self.data[chunk_row, chunk_col, :rows, :cols]
+
+    def write_chunk(self, chunk_row, chunk_col, chunk):
+        rows, cols = self.chunk_shape(chunk_row, chunk_col)
+        self.data[chunk_row, chunk_col, :rows, :cols] = chunk
+        self.data.flush()
+        # Only mark the chunk as present once its data is in the file
+        self.chunk_table[chunk_row, chunk_col] = 1
+        self.chunk_table.flush()
+
+
+def chunk_grid(height, width, chunk_size):
+    return -(-height // chunk_size), -(-width // chunk_size)
+
+
+def data_offset(chunk_rows, chunk_cols):
+    table_size = chunk_rows * chunk_cols
+    return HEADER_SIZE + -(-table_size // PAGE_SIZE) * PAGE_SIZE
+
+
+def convert_pickled_chunks(chunk_dir, store):
+    """
+    Copy every chunk_{x}_{y}.pkl written by the old generate_chunks into
+    store. Those chunks were indexed [x][y], so they are transposed on the
+    way in. Returns the number of chunks converted.
+    """
+    converted = 0
+    for filename in sorted(os.listdir(chunk_dir)):
+        match = re.fullmatch(r'chunk_(\d+)_(\d+)\.pkl', filename)
+        if not match:
+            continue
+        x, y = int(match.group(1)), int(match.group(2))
+        with open(os.path.join(chunk_dir, filename), 'rb') as f:
+            chunk = np.asarray(pickle.load(f), dtype=store.dtype).transpose(1, 0, 2)
+        chunk_row, chunk_col = y // store.chunk_size, x // store.chunk_size
+        if chunk.shape != (*store.chunk_shape(chunk_row, chunk_col), store.layers):
+            raise ValueError(
+                f"{filename} has shape {chunk.shape}, which does not fit the store.")
+        store.write_chunk(chunk_row, chunk_col, chunk)
+        converted += 1
+    return converted
@@ -0,0 +1,60 @@
+from sqlalchemy import select
+from models import db, City, Outpost, Building
+
+# Response fields of each model, selected as plain columns so responses are
+# built without loading ORM instances or walking SerializerMixin rules
+CITY_FIELDS = ('id', 'name', 'level')
+OUTPOST_FIELDS = ('id', 'city_id', 'coord', 'level', 'resources', 'x', 'y')
+BUILDING_FIELDS = ('id', 'building_id', 'level', 'outpost_id',
+                   'coord', 'resource', 'rate', 'x', 'y')
+
+CITY_COLUMNS = [getattr(City, field) for field in CITY_FIELDS]
+OUTPOST_COLUMNS = [getattr(Outpost, field) for field in OUTPOST_FIELDS]
+BUILDING_COLUMNS = [getattr(Building, field) for field in BUILDING_FIELDS]
+
+
+def rows_to_dicts(fields, rows):
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def building_select(*criteria):
+    return select(*BUILDING_COLUMNS).where(*criteria).order_by(Building.id)
+
+
+def outpost_select(*criteria):
+    return select(*OUTPOST_COLUMNS).where(*criteria).order_by(Outpost.id)
+
+
+def building_dicts(*criteria):
+    rows = db.session.execute(building_select(*criteria)).all()
+    return rows_to_dicts(BUILDING_FIELDS, rows)
+
+
+def outpost_dicts(*criteria, buildings=False):
+    """
+    Outposts matching criteria. With buildings=True each gets its buildings
+    from a single second query, the same one selectinload would issue.
+    """
+    outposts = rows_to_dicts(OUTPOST_FIELDS, db.session.execute(
+        outpost_select(*criteria)).all())
+    if buildings and outposts:
+        by_id = {}
+        for outpost in outposts:
+            outpost['buildings'] = []
+            by_id[outpost['id']] = outpost
+        for building in building_dicts(Building.outpost_id.in_(list(by_id))):
+            by_id[building['outpost_id']]['buildings'].append(building)
+    return outposts
+
+
+def city_dicts(*criteria):
+    cities = rows_to_dicts(CITY_FIELDS, db.session.query(*CITY_COLUMNS).filter(
+        *criteria).order_by(City.id).all())
+    if cities:
+        by_id = {}
+        for city in cities:
+            city['outposts'] = []
+            by_id[city['id']] = city
+        for outpost in outpost_dicts(Outpost.city_id.in_(list(by_id)), buildings=True):
+            by_id[outpost['city_id']]['outposts'].append(outpost)
+    return cities
@@ -1,5 +1,9 @@
 from dotenv import load_dotenv
+import hashlib
+import hmac
 import os
+import threading
+import time
 from sqlalchemy import MetaData
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -56,7 +60,82 @@ fernet_key = os.getenv('FERNET')
 cipher_suite = Fernet(fernet_key)
 
 
+# Keyed hash of API keys, so a key can be looked up without decrypting.
+# Falls back to SECRET, then to the FERNET key every deployment already has
+api_key_secret = os.getenv('API_KEY_SECRET') or app.secret_key or fernet_key
+if not api_key_secret:
+    raise ValueError("Set API_KEY_SECRET, SECRET or FERNET to hash API keys.")
+api_key_secret = api_key_secret.encode()
+API_KEY_HEADER = 'X-API-Key'
+
+
+def hash_api_key(api_key):
+    return hmac.new(api_key_secret, api_key.encode(), hashlib.sha256).hexdigest()
+
+
+class UserCache:
+    """
+    Short-lived snapshots of user rows keyed by id or API key hash, so
+    authenticated requests skip the user query. Entries are dropped when
+    the user is updated or deleted, and expire after ttl seconds.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            return entry[2]
+
+    def put(self, key, user):
+        from models import User  # Import here to avoid circular import
+        snapshot = {column.key: getattr(user, column.key)
+                    for column in User.__table__.columns}
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, user.id, snapshot)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[1] == user_id]:
+                del self.entries[key]
+
+
+user_cache = UserCache()
+
+
+def cached_user(key, query):
+    from models import User  # Import here to avoid circular import
+    from sqlalchemy.orm import make_transient_to_detached
+    snapshot = user_cache.get(key)
+    if snapshot is None:
+        user = query()
+        if user is not None:
+            user_cache.put(key, user)
+        return user
+    # Attach a copy to this request's session without querying
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     from models import User  # Import here to avoid circular import
-    return User.query.get(int(user_id))
+    return cached_user(('id', int(user_id)), lambda: User.query.get(int(user_id)))
+
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    # Stateless auth for bots, no cookie session or bcrypt login needed
+    from models import User  # Import here to avoid circular import
+    api_key = request.headers.get(API_KEY_HEADER)
+    if not api_key:
+        return None
+    key_hash = hash_api_key(api_key)
+    return cached_user(('key', key_hash), lambda: User.query.filter_by(api_key_hash=key_hash).first())
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import threading
+from app import m, get_map_encoding, get_map_detail, check_map_window
+from proc_map.map import LAYERS
+from models import Building, Outpost
+from occupancy import register
+from proc_map.encoding import ENCODINGS, encode_region
+from serializers import building_select, outpost_select, BUILDING_FIELDS, OUTPOST_FIELDS
+
+# WebSocket /map/stream: the client sends {"x", "y", "r"} whenever its
+# viewport moves and gets back only the tiles that became visible, plus
+# building/outpost create and delete events inside the viewport.
+
+# Messages a connection may have waiting before it is dropped as too slow
+MAX_QUEUED = 1000
+# WebSocket close code "Try Again Later", sent to a client that fell behind
+CLOSE_OVERLOADED = 1013
+
+
+def offer(queue, item):
+    # Runs on the connection's loop. A client too slow to keep up gets its
+    # backlog replaced by a single overflow message
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(('overflow', None))
+
+
+class StructureFeed:
+    """
+    Fans committed placement changes out to subscribed event loop queues.
+    Registered with the placement indexes, so apply() runs on whichever
+    thread committed, inside its after_commit hook, and on the
+    PlacementListener thread for commits made by other server processes.
+    It never raises.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, loop, queue):
+        with self.lock:
+            self.subscribers.add((loop, queue))
+
+    def unsubscribe(self, loop, queue):
+        with self.lock:
+            self.subscribers.discard((loop, queue))
+
+    def apply(self, changes):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for loop, queue in subscribers:
+            try:
+                for change in changes:
+                    loop.call_soon_threadsafe(offer, queue, ('change', change))
+            except RuntimeError:
+                # The connection's loop has closed
+                self.unsubscribe(loop, queue)
+
+
+feed = register(StructureFeed())
+
+
+def clip(bounds):
+    min_x, min_y, max_x, max_y = bounds
+    min_x, min_y = max(0, min_x), max(0, min_y)
+    return min_x, min_y, max(min_x, min(m.width, max_x)), max(min_y, min(m.height, max_y))
+
+
+def newly_visible(old, new):
+    """
+    Split the part of window new (min_x, min_y, max_x, max_y) outside
+    window old into at most four non-overlapping rectangles.
+    """
+    if old is None or old[0] >= new[2] or new[0] >= old[2] or old[1] >= new[3] or new[1] >= old[3]:
+        return [new] if new[0] < new[2] and new[1] < new[3] else []
+    min_x, min_y, max_x, max_y = new
+    strips = [(min_x, min_y, old[0], max_y),
+              (old[2], min_y, max_x, max_y)]
+    # Top and bottom strips only span the columns shared with old
+    mid_x, end_x = max(min_x, old[0]), min(max_x, old[2])
+    strips += [(mid_x, min_y, end_x, old[1]),
+               (mid_x, old[3], end_x, max_y)]
+    return [strip for strip in strips if strip[0] < strip[2] and strip[1] < strip[3]]
+
+
+def in_bounds(bounds, x, y):
+    return bounds is not None and bounds[0] <= x < bounds[2] and bounds[1] <= y < bounds[3]
+
+
+def strip_criteria(model, bounds):
+    min_x, min_y, max_x, max_y = bounds
+    return model.x >= min_x, model.x < max_x, model.y >= min_y, model.y < max_y
+
+
+async def tiles_message(bounds, layers, encoding, fetch_dicts):
+    min_x, min_y, max_x, max_y = bounds
+    loop = asyncio.get_running_loop()
+    region, buildings, outposts = await asyncio.gather(
+        loop.run_in_executor(None, m.read_window, min_y, max_y, min_x, max_x),
+        fetch_dicts(building_select(*strip_criteria(Building, bounds)), BUILDING_FIELDS),
+        fetch_dicts(outpost_select(*strip_criteria(Outpost, bounds)), OUTPOST_FIELDS))
+    return {'type': 'tiles',
+            'bounds': list(bounds),
+            'layers': layers,
+            'map_data': encode_region(region[..., layers], encoding),
+            'buildings': buildings,
+            'outposts': outposts}
+
+
+async def handle_stream(req, receive, send, fetch_dicts, dumps):
+    """
+    Serve one accepted WebSocket. fetch_dicts runs a select on the async
+    pool and dumps encodes a message, both supplied by the ASGI app.
+    """
+    # Encoding and layers come from the query string, as for /map
+    encoding = get_map_encoding(req)
+    if encoding not in ENCODINGS:
+        encoding = 'json'
+    try:
+        layers, _ = get_map_detail(req)
+    except ValueError:
+        layers = list(range(LAYERS))
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=MAX_QUEUED)
+
+    async def read_client():
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                await queue.put(('closed', None))
+                return
+            if message.get('text'):
+                await queue.put(('viewport', message['text']))
+
+    async def push(payload):
+        await send({'type': 'websocket.send', 'text': dumps(payload)})
+
+    feed.subscribe(loop, queue)
+    reader = asyncio.create_task(read_client())
+    bounds = None
+    try:
+        while True:
+            kind, item = await queue.get()
+            if kind == 'closed':
+                return
+            if kind == 'overflow':
+                await send({'type': 'websocket.close', 'code': CLOSE_OVERLOADED})
+                return
+            if kind == 'viewport':
+                try:
+                    viewport = json.loads(item)
+                    x, y, r = int(viewport['x']), int(viewport['y']), int(viewport.get('r', 50))
+                except (ValueError, KeyError, TypeError):
+                    await push({'type': 'error', 'message': 'Viewport needs integer x, y and r!'})
+                    continue
+                # The viewport is read at lod 0, so it gets /map's lod 0 limits
+                error = await loop.run_in_executor(None, check_map_window, x, y, r)
+                if error:
+                    await push({'type': 'error', 'message': error[0], 'status': error[1]})
+                    continue
+                new_bounds = clip((x - r, y - r, x + r, y + r))
+                for strip in newly_visible(bounds, new_bounds):
+                    await push(await tiles_message(strip, layers, encoding, fetch_dicts))
+                bounds = new_bounds
+                await push({'type': 'viewport', 'bounds': list(bounds)})
+            elif kind == 'change':
+                table, row_id, _, x, y, delta = item
+                if not in_bounds(bounds, x, y):
+                    continue
+                event = {'type': 'created' if delta > 0 else 'deleted',
+                         'table': table, 'id': row_id, 'x': x, 'y': y}
+                if delta > 0:
+                    # The row as /map would return it
+                    if table == Building.__tablename__:
+                        rows = await fetch_dicts(building_select(Building.id == row_id), BUILDING_FIELDS)
+                    else:
+                        rows = await fetch_dicts(outpost_select(Outpost.id == row_id), OUTPOST_FIELDS)
+                    if not rows:
+                        continue
+                    event['row'] = rows[0]
+                await push(event)
+    finally:
+        feed.unsubscribe(loop, queue)
+        reader.cancel()